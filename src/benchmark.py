@@ -0,0 +1,589 @@
+"""
+This script is used to benchmark the pipeline. Every stage, from the
+conversion of raw records to the creation of the dataset, is timed on
+synthetic records of several lengths (see `synthetic.py`, as the Database
+is not part of the repository). The results can be written as json and
+compared with the results of an earlier run to find regressions:
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json
+The original loop based implementations of the de-noising and peak
+detection steps are also kept here as reference oracles, so that the
+current implementation can be checked against them with `--references`,
+which exits with 1 if any of them does not match:
+    python benchmark.py --references
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pywt
+from scipy.signal import butter, lfilter
+
+import paths as const
+import clean_signal
+import denoise
+import load_data
+import metrics
+import normalise
+import peak_detection
+import preprocess
+import raw_to_csv
+import synthetic
+
+
+"""
+Reference implementation of `denoise.calc_energy` which sums the squares
+of the cofficients one at a time.
+"""
+
+def reference_calc_energy(level):
+    res = 0.0
+    for coff in level:
+        res += coff*coff
+
+    res = np.log(res)
+    return res
+
+
+"""
+Reference implementation of `denoise.soft_thresh` which copies all the
+cofficients and thresholds them one at a time.
+"""
+
+def reference_soft_thresh(coffs, levels, denoise_loc, thresh, wavelet):
+    soft_coff = copy.deepcopy(coffs)
+
+    st = levels - denoise_loc + 2
+    en = levels + 1
+
+    for i in range(st, en):
+        for pos in range(0, len(soft_coff[i])):
+
+            coff = soft_coff[i][pos]
+
+            if abs(coff) < thresh[i-1]:
+                soft_coff[i][pos] = 0
+            else:
+                soft_coff[i][pos] = (np.sign(coff) * (abs(coff) - thresh[i-1]))
+
+    signal = pywt.waverec(soft_coff, wavelet)
+    return signal
+
+
+"""
+Reference implementation of `denoise.smooth` which walks the signal twice
+and builds the result as a list.
+"""
+
+def reference_smooth(signal):
+    n = len(signal)
+    res = []; lmaxs = []; upmins = []
+
+    for i in range(1,n-1):
+        pre = signal[i-1]
+        cur = signal[i]
+        nex = signal[i+1]
+
+        if cur < pre and cur < nex:
+            upmins.append(cur)
+        if cur > pre and cur > nex:
+            lmaxs.append(cur)
+
+    lmax = np.amin(lmaxs)
+    upmin = np.amax(upmins)
+
+    if lmax < upmin:
+        lmax, upmin = upmin, lmax
+
+    res.append(signal[0])
+    for i in range(1,n-1):
+        pre = signal[i-1]
+        cur = signal[i]
+        nex = signal[i+1]
+
+        if upmin <= cur and cur <= lmax:
+            if (upmin <= pre and pre <= lmax) and \
+               (upmin <= nex and nex <= lmax):
+                res.append((pre+cur+nex)/3)
+
+            if (upmin <= pre and pre <= lmax) and \
+               (not (upmin <= nex and nex <= lmax)):
+                res.append((pre+cur)/2)
+
+            if (not (upmin <= pre and pre <= lmax)) and \
+               (upmin <= nex and nex <= lmax):
+                res.append((nex+cur)/2)
+
+            if (not (upmin <= pre and pre <= lmax)) and \
+               (not (upmin <= nex and nex <= lmax)):
+                res.append(cur)
+
+        else:
+            res.append(cur)
+
+    res.append(signal[n-1])
+    return res
+
+
+"""
+Reference implementation of `peak_detection.pan_peak_detect` which checks
+every sample of the integrated signal for a local maxima.
+"""
+
+def reference_pan_peak_detect(detection, fs):
+    min_distance = int(0.25*fs)
+
+    signal_peaks = [0]
+    noise_peaks = []
+
+    SPKI = 0.0
+    NPKI = 0.0
+
+    threshold_I1 = 0.0
+    threshold_I2 = 0.0
+
+    RR_missed = 0
+    index = 0
+    indexes = []
+
+    missed_peaks = []
+    peaks = []
+
+    for i in range(len(detection)):
+
+        if i>0 and i<len(detection)-1:
+            if detection[i-1]<detection[i] \
+               and detection[i+1]<detection[i]:
+                peak = i
+                peaks.append(i)
+
+                if detection[peak]>threshold_I1 \
+                   and (peak-signal_peaks[-1])>0.3*fs:
+                        
+                    signal_peaks.append(peak)
+                    indexes.append(index)
+                    SPKI = 0.125*detection[signal_peaks[-1]] \
+                           + 0.875*SPKI
+                    if RR_missed!=0:
+                        if signal_peaks[-1]-signal_peaks[-2]>RR_missed:
+                            missed_section_peaks = peaks[indexes[-2]+1:indexes[-1]]
+                            missed_section_peaks2 = []
+                            for missed_peak in missed_section_peaks:
+                                if missed_peak-signal_peaks[-2]>min_distance \
+                                   and signal_peaks[-1]-missed_peak>min_distance \
+                                   and detection[missed_peak]>threshold_I2:
+                                    missed_section_peaks2.append(missed_peak)
+
+                            if len(missed_section_peaks2)>0:           
+                                missed_peak = missed_section_peaks2[np.argmax(detection[missed_section_peaks2])]
+                                missed_peaks.append(missed_peak)
+                                signal_peaks.append(signal_peaks[-1])
+                                signal_peaks[-2] = missed_peak   
+
+                else:
+                    noise_peaks.append(peak)
+                    NPKI = 0.125*detection[noise_peaks[-1]] + 0.875*NPKI
+
+                threshold_I1 = NPKI + 0.25*(SPKI-NPKI)
+                threshold_I2 = 0.5*threshold_I1
+
+                if len(signal_peaks)>8:
+                    RR = np.diff(signal_peaks[-9:])
+                    RR_ave = int(np.mean(RR))
+                    RR_missed = int(1.66*RR_ave)
+
+                index = index+1      
+    
+    signal_peaks.pop(0)
+
+    return signal_peaks
+
+
+"""
+This function runs the wavelet stage of `denoise.denoise_signal` i.e.
+decomposition, energy and threshold calculation and soft thresholding.
+params:
+    signal -> signal to be processed
+    calc_energy -> implementation of `denoise.calc_energy` to use
+    soft_thresh -> implementation of `denoise.soft_thresh` to use
+return:
+    thresholded signal
+"""
+
+def wavelet_stage(signal, calc_energy, soft_thresh):
+    signal = signal - np.mean(signal, dtype=np.float64)
+
+    levels = 10
+    wavelet = "db5"
+    coffs = pywt.wavedec(signal, wavelet, level=levels)
+
+    energy = [calc_energy(level) for level in coffs[1:]]
+    thresh = [denoise.calc_threshold(level, len(signal)) for level in coffs[1:]]
+    energy.reverse()
+
+    denoise_loc = denoise.find_denoise_level(energy)
+    return soft_thresh(coffs, levels, denoise_loc, thresh, wavelet)
+
+
+"""
+This function computes the integrated signal of a whole signal at once,
+which is the input of `pan_peak_detect`.
+"""
+
+def integrated_signal(signal, fs):
+    f_low = 5/fs
+    f_high = 15/fs
+
+    b, a = butter(1, [f_low*2, f_high*2], btype='bandpass')
+    diff = np.diff(lfilter(b, a, signal))
+
+    mwa = peak_detection.cumulate(diff*diff, int(0.12*fs))
+    mwa[:int(0.2*fs)] = 0
+    return mwa
+
+
+"""
+This function times `func` over all the signals.
+return:
+    records processed per second and the outputs
+"""
+
+def time_records(func, signals):
+    outputs = []
+    start = time.perf_counter()
+    for signal in signals:
+        outputs.append(func(signal))
+    elapsed = time.perf_counter() - start
+
+    return len(signals) / elapsed, outputs
+
+
+# chunk sizes with which `peak_detection.StreamingPeakDetector` is checked,
+# None standing for the whole signal at once
+STREAM_CHUNKS = [1, 7, 1000, None]
+
+# duration in seconds of the part of each signal streamed, as one sample at
+# a time is slow
+STREAM_SECONDS = 60.0
+
+
+"""
+This function feeds a signal to `peak_detection.StreamingPeakDetector` in
+chunks of the same size.
+params:
+    signal -> denoised signal
+    fs -> sampling frequency of the signal
+    chunk_size -> no. of samples in each chunk, the whole signal if None
+return:
+    indices of the peaks
+"""
+
+def stream_peaks(signal, fs, chunk_size=None):
+    detector = peak_detection.StreamingPeakDetector(fs)
+    chunk_size = chunk_size or max(len(signal), 1)
+
+    peaks = []
+    for start in range(0, len(signal), chunk_size):
+        peaks += detector.process(signal[start : start + chunk_size])
+
+    return peaks
+
+
+"""
+This function compares the vectorised de-noising and peak detection steps
+against their reference implementations and prints the records per second
+of both along with the difference between their outputs. Smoothing and
+peak detection are compared exactly against their references, while the
+soft thresholding may differ by floating point rounding.
+params:
+    records -> no. of signals
+    seconds -> duration of each signal
+    fs -> sampling frequency of the signals
+    max_difference -> max abs difference allowed between the soft
+                      thresholded signals and their reference
+return:
+    names of the steps which do not match their reference
+"""
+
+def check_references(records, seconds, fs, max_difference=1e-9):
+    signals = [synthetic.generate(fs, seconds, leads=1, seed=seed)[0][:, 0]
+               for seed in range(records)]
+
+    before, ref = time_records(
+        lambda s: wavelet_stage(s, reference_calc_energy, reference_soft_thresh),
+        signals)
+    after, res = time_records(
+        lambda s: wavelet_stage(s, denoise.calc_energy, denoise.soft_thresh),
+        signals)
+
+    diff = max(np.max(np.absolute(a - b)) for a, b in zip(ref, res))
+
+    print("soft threshold")
+    print("before: %10.3f records/s" %(before))
+    print("after:  %10.3f records/s" %(after))
+    print("max abs difference: %g" %(diff))
+
+    failed = []
+    if not diff <= max_difference:
+        failed.append("soft threshold")
+
+    before, ref = time_records(reference_smooth, res)
+    after, smoothed = time_records(denoise.smooth, res)
+
+    exact = all(np.array_equal(a, b) for a, b in zip(ref, smoothed))
+
+    print("smooth")
+    print("before: %10.3f records/s" %(before))
+    print("after:  %10.3f records/s" %(after))
+    print("matches reference:", exact)
+
+    if not exact:
+        failed.append("smooth")
+
+    mwas = [integrated_signal(signal, fs) for signal in smoothed]
+
+    before, ref = time_records(
+        lambda m: reference_pan_peak_detect(m, fs), mwas)
+    after, peaks = time_records(
+        lambda m: peak_detection.pan_peak_detect(m, fs), mwas)
+
+    print("peak detection")
+    print("before: %10.3f records/s" %(before))
+    print("after:  %10.3f records/s" %(after))
+    print("matches reference:", ref == peaks)
+
+    if ref != peaks:
+        failed.append("peak detection")
+
+    # the peaks of the streaming detector must not depend on the chunk size
+    parts = [signal[:int(STREAM_SECONDS * fs)] for signal in smoothed]
+    ref = [reference_pan_peak_detect(integrated_signal(part, fs), fs) for part in parts]
+
+    print("streaming peak detection")
+    for chunk_size in STREAM_CHUNKS:
+        exact = all(stream_peaks(part, fs, chunk_size) == peaks
+                    for part, peaks in zip(parts, ref))
+        print("chunks of %-8s matches reference:" %(chunk_size or "all"), exact)
+
+        if not exact:
+            failed.append("streaming peak detection in chunks of %s" %(chunk_size or "all"))
+
+    return failed
+
+
+"""
+This function runs `func` several times.
+params:
+    func -> function to time
+    repeat -> no. of runs
+return:
+    best and median time of the runs in seconds and the output of the
+    last run
+"""
+
+def time_stage(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func()
+        times.append(time.perf_counter() - start)
+
+    return min(times), float(np.median(times)), output
+
+
+"""
+This function times every stage of the pipeline on a synthetic record of
+the given length. The record is written as a wfdb record in its own
+Database, which the stages find through `ECG_DATABASE`. `to_csv`
+converts the whole record, so that every stage handles the same no. of
+samples.
+params:
+    workdir -> folder in which the synthetic Database is created
+    seconds -> duration of the record
+    fs -> sampling frequency of the record
+    repeat -> no. of runs of each stage
+return:
+    list of results, one per stage
+"""
+
+def time_pipeline(workdir, seconds, fs, repeat):
+    database = synthetic.make_database(workdir, 1, fs, seconds)
+    os.environ[const.ENV_VAR] = database
+    const.find_paths(refresh=True)
+
+    signal, _ = synthetic.generate(fs, seconds, seed=0)
+    dataset = {"lead1": signal[:, 0], "lead2": signal[:, 1]}
+    n = len(signal)
+
+    stages = []
+
+    stages.append(("raw_to_csv.to_csv", lambda: raw_to_csv.to_csv("100", (0, None))))
+    stages.append(("load_data.load_data", lambda: load_data.load_data()))
+
+    stages.append(("denoise.denoise", lambda: denoise.denoise([dataset])[0]))
+    stages.append(("clean_signal.remove_baseline_wander",
+                   lambda: clean_signal.remove_baseline_wander(outputs["denoise.denoise"], fs)))
+    stages.append(("peak_detection.detect_peaks",
+                   lambda: peak_detection.detect_peaks(
+                       outputs["clean_signal.remove_baseline_wander"], fs)))
+    stages.append(("preprocess.segment",
+                   lambda: preprocess.segment(outputs["clean_signal.remove_baseline_wander"],
+                                              outputs["peak_detection.detect_peaks"])))
+    stages.append(("normalise.create_df",
+                   lambda: normalise.create_df(data, normalise.find_size(data))))
+
+    outputs = {}
+    results = []
+
+    for stage, func in stages:
+        if stage == "normalise.create_df":
+            data = {"100": outputs["preprocess.segment"]}
+
+        best, median, outputs[stage] = time_stage(func, repeat)
+        results.append({
+            "stage": stage,
+            "seconds": seconds,
+            "samples": n,
+            "best": best,
+            "median": median,
+            "samples_per_second": n / best,
+        })
+        print("%-40s %10.0f s %12.4f s" %(stage, seconds, best))
+
+    return results
+
+
+"""
+This function runs the benchmark suite at every length.
+params:
+    lengths -> durations of the records in seconds
+    fs -> sampling frequency of the records
+    repeat -> no. of runs of each stage
+return:
+    dictionary with the environment, the settings and the results
+"""
+
+def run_suite(lengths, fs, repeat):
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for seconds in lengths:
+            workdir = os.path.join(tmp, "%g" % seconds)
+            results += time_pipeline(workdir, seconds, fs, repeat)
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "fs": fs,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+"""
+This function compares results with a baseline. Stages are matched by name
+and no. of samples, and a stage has regressed if its best time is more
+than `tolerance` times slower than in the baseline.
+params:
+    report -> results of `run_suite`
+    baseline -> results of an earlier `run_suite`
+    tolerance -> allowed relative slow down e.g. 0.2 for 20 %
+return:
+    list of regressions, each with the stage, no. of samples and both times
+"""
+
+def compare(report, baseline, tolerance):
+    before = {(res["stage"], res["samples"]): res["best"]
+              for res in baseline["results"]}
+
+    regressions = []
+
+    for res in report["results"]:
+        key = (res["stage"], res["samples"])
+        if key not in before:
+            print("%-40s %10d %10s" %(res["stage"], res["samples"], "new"))
+            continue
+
+        ratio = res["best"] / before[key]
+        flag = "REGRESSION" if ratio > 1.0 + tolerance else ""
+        print("%-40s %10d %9.2fx %s" %(res["stage"], res["samples"], ratio, flag))
+
+        if flag:
+            regressions.append({"stage": res["stage"], "samples": res["samples"],
+                                "baseline": before[key], "current": res["best"]})
+
+    return regressions
+
+
+"""
+Driver function which runs the benchmark suite, writes its results and
+compares them with a baseline. With `--references` the vectorised steps are
+compared against their reference implementations instead. Exits with 1 if
+any stage has regressed or does not match its reference.
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ECG pipeline.")
+    parser.add_argument("--lengths", type=float, nargs="+", default=[60.0, 600.0, 7200.0],
+                        help="durations of the records in seconds")
+    parser.add_argument("--fs", type=int, default=360)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="no. of runs of each stage, the best is kept")
+    parser.add_argument("--output", default=None,
+                        help="json file to which the results are written")
+    parser.add_argument("--compare", default=None,
+                        help="json file of a baseline to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative slow down before a stage is "
+                             "flagged as a regression")
+    parser.add_argument("--references", action="store_true",
+                        help="compare against the reference implementations")
+    parser.add_argument("--records", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=600.0)
+    parser.add_argument("--max-difference", type=float, default=1e-9,
+                        help="allowed max abs difference of the soft "
+                             "thresholded signals from their reference")
+    args = parser.parse_args()
+
+    if args.references:
+        failed = check_references(args.records, args.seconds, args.fs,
+                                  args.max_difference)
+        if failed:
+            print("Do not match their reference:", ", ".join(failed))
+            sys.exit(1)
+        return
+
+    # progress lines of the stages would be mixed with the timings
+    metrics.set_quiet()
+
+    report = run_suite(args.lengths, args.fs, args.repeat)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+        print("====================== Comparison With The Baseline ======================")
+        regressions = compare(report, baseline, args.tolerance)
+
+        if regressions:
+            print(len(regressions), "stages have regressed")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,30 +5,50 @@ frequency baseline wander noise and high frequency noises like EMG, poweline
 interference are removed.
 """
 
-from scipy.signal import butter, filtfilt 
-
 import denoise
+import filters
+import metrics
+import pipeline
 
 
 """
-This function is used to remove baseline wander noise. It uses a HPF of order
-4 to perform the task.
+This function is used to remove baseline wander noise. It uses a zero phase
+HPF of order 4 to perform the task. The signal is filtered in chunks, so
+long or memory mapped recordings can be cleaned without holding several
+copies of them in memory.
 params:
     signal -> signal which needs to be cleaned
     fs -> sampling frequency of the signal
+    plan -> pipeline plan holding the HPF, compiled for `fs` if None
+    out -> array in which the result is written, e.g. a memory mapped
+           file, a new array is allocated if None
 return:
     signal with baseline wander removed
 """
 
-def remove_baseline_wander(signal, fs):
-    nyq = 0.5 * fs
-    cutoff = 0.5
-    freq = cutoff / nyq
-    order = 4
+def remove_baseline_wander(signal, fs, plan=None, out=None):
+    if plan is None:
+        plan = pipeline.get_plan(fs)
+
+    return filters.sos_filtfilt(plan.highpass, signal, plan.chunk_size, out)
+
+
+"""
+This function is used to clean a single ECG signal from all noises.
+params:
+    signal -> noisy signal
+    fs -> sampling frequency of the signal
+    plan -> pipeline plan, compiled for `fs` if None
+return:
+    clean signal after applying filters
+"""
+
+def clean_record(signal, fs, plan=None):
+    if plan is None:
+        plan = pipeline.get_plan(fs)
 
-    b, a = butter(order, freq, 'high')
-    res = filtfilt(b, a, signal)
-    return res
+    denoised = denoise.denoise_signal(signal, plan)
+    return remove_baseline_wander(denoised, fs, plan)
 
 
 """
@@ -45,7 +65,7 @@ return:
 def clean_signal(freqs, datasets):
     denoised_signals = denoise.denoise(datasets)
 
-    print("======================= High Frequency Noise Removed ======================")
+    metrics.message("======================= High Frequency Noise Removed ======================")
 
 
     clean_signals = []
@@ -54,7 +74,7 @@ def clean_signal(freqs, datasets):
         signal = denoised_signals[idx]
         fs = freqs[idx]
 
-        print("Removing low frequency noise from patient", idx + 1, "data", end = '\r')
+        metrics.progress("Removing low frequency noise from patient", idx + 1, "data")
 
         clean_signals.append(remove_baseline_wander(signal, fs))
 
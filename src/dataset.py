@@ -0,0 +1,381 @@
+"""
+This script is used to store the normalised dataset in a binary format.
+A dataset is a folder containing:
+    segments.bin -> float32 matrix of segments, one row per segment
+    labels.csv -> id of the patient of each segment, one row per segment
+    meta.json -> no. of rows, width, no. of leads (for segments of several
+                 leads) and data type of the matrix
+The matrix can be memory mapped, so that the dataset does not have to fit
+in memory to be used. `BatchLoader` reads shuffled batches from it for
+training. `DatasetWriter` writes a dataset a few segments at a time and can
+append new segments to an existing dataset; the no. of rows in meta.json is
+only updated once the rows are written, so the rows it counts are always
+complete.
+"""
+
+import json
+import os
+import threading
+from queue import Full, Queue
+
+import numpy as np
+import pandas as pd
+
+import fileutil
+
+
+SEGMENTS_FILE = "segments.bin"
+LABELS_FILE = "labels.csv"
+META_FILE = "meta.json"
+
+
+"""
+This function writes a dataset.
+params:
+    path -> folder in which the dataset is written
+    segments -> 2-D array of segments, or 3-D array with the leads of each
+                segment as its last axis
+    labels -> id of the patient of each segment
+return: None
+"""
+
+def write_dataset(path, segments, labels):
+    segments = np.asarray(segments, dtype=np.float32)
+    labels = np.asarray(labels).astype(str)
+
+    if segments.ndim not in (2, 3) or len(segments) != len(labels):
+        raise ValueError("Segments must be a 2-D or 3-D array with one label per row.")
+
+    os.makedirs(path, exist_ok=True)
+
+    segments.tofile(os.path.join(path, SEGMENTS_FILE))
+    pd.DataFrame({"label": labels}).to_csv(os.path.join(path, LABELS_FILE),
+                                           index=False)
+
+    meta = {
+        "rows": int(segments.shape[0]),
+        "width": int(segments.shape[1]),
+        "dtype": np.dtype(np.float32).str,
+    }
+    if segments.ndim == 3:
+        meta["leads"] = int(segments.shape[2])
+    with open(os.path.join(path, META_FILE), "w") as file:
+        json.dump(meta, file, indent=1)
+
+
+"""
+This function reads the meta data of a dataset.
+params:
+    path -> folder containing the dataset
+return:
+    dictionary of the meta data, None if there is no dataset in `path`
+"""
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, META_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+"""
+This function writes the meta data of a dataset. The file is replaced at
+once, so readers never see a partly written file.
+params:
+    path -> folder containing the dataset
+    meta -> dictionary of the meta data
+return: None
+"""
+
+def write_meta(path, meta):
+    fileutil.write_atomic(os.path.join(path, META_FILE),
+                          lambda file: json.dump(meta, file, indent=1), "w")
+
+
+"""
+This function loads a dataset.
+params:
+    path -> folder containing the dataset
+    mmap -> if True the segments are memory mapped instead of being read
+return:
+    2-D array of segments and array of labels
+"""
+
+def load_dataset(path, mmap=True):
+    meta = read_meta(path)
+    if meta is None:
+        raise FileNotFoundError("No dataset in %s." % path)
+
+    shape = (meta["rows"], meta["width"])
+    if "leads" in meta:
+        shape += (meta["leads"],)
+    dtype = np.dtype(meta["dtype"])
+    segments_path = os.path.join(path, SEGMENTS_FILE)
+
+    if mmap and shape[0] > 0:
+        segments = np.memmap(segments_path, dtype=dtype, mode="r", shape=shape)
+    else:
+        segments = np.fromfile(segments_path, dtype=dtype,
+                               count=int(np.prod(shape))).reshape(shape)
+
+    labels = pd.read_csv(os.path.join(path, LABELS_FILE), dtype={"label": str},
+                         nrows=shape[0])["label"].to_numpy()
+
+    return segments, labels
+
+
+"""
+This class writes a dataset a few segments at a time, e.g. patient by
+patient as they are preprocessed, so that the whole dataset never has to
+be held in memory. Every `write` appends to segments.bin and labels.csv and
+then updates meta.json. Rows written after the last update of meta.json
+(e.g. by a writer which was killed) are dropped when the dataset is opened
+again.
+params:
+    path -> folder in which the dataset is written
+    width -> no. of samples in each segment
+    leads -> no. of leads of each segment for 3-D segments, None for 2-D
+    append -> if True the segments are added after the rows of the dataset
+              in `path`, which are not modified. Otherwise the dataset is
+              written from scratch.
+`patients` holds the distinct labels of the dataset.
+"""
+
+class DatasetWriter:
+    def __init__(self, path, width, leads=None, append=False):
+        self.path = path
+        self.shape = (width,) if leads is None else (width, leads)
+
+        os.makedirs(path, exist_ok=True)
+
+        meta = read_meta(path) if append else None
+        if meta is None:
+            meta = {"rows": 0, "width": int(width), "dtype": np.dtype(np.float32).str}
+            if leads is not None:
+                meta["leads"] = int(leads)
+            append = False
+        elif meta["width"] != width or meta.get("leads") != leads \
+             or np.dtype(meta["dtype"]) != np.float32:
+            raise ValueError("Segments of width %s and %s leads can not be appended "
+                             "to a dataset of width %s and %s leads."
+                             % (width, leads, meta["width"], meta.get("leads")))
+        self.meta = meta
+
+        segments_path = os.path.join(path, SEGMENTS_FILE)
+        labels_path = os.path.join(path, LABELS_FILE)
+
+        if append:
+            self.patients = set(pd.read_csv(labels_path, dtype={"label": str},
+                                            nrows=meta["rows"])["label"])
+            self.truncate(segments_path, labels_path)
+            self.segments_file = open(segments_path, "ab")
+            self.labels_file = open(labels_path, "a", newline="")
+        else:
+            self.patients = set()
+            self.segments_file = open(segments_path, "wb")
+            self.labels_file = open(labels_path, "w", newline="")
+            self.labels_file.write("label\n")
+            self.labels_file.flush()
+            write_meta(path, meta)
+
+    """
+    This function drops the rows written after the last update of
+    meta.json.
+    params:
+        segments_path -> path of segments.bin
+        labels_path -> path of labels.csv
+    return: None
+    """
+
+    def truncate(self, segments_path, labels_path):
+        rows = self.meta["rows"]
+        row_bytes = int(np.prod(self.shape)) * np.dtype(np.float32).itemsize
+
+        if os.path.getsize(segments_path) > rows * row_bytes:
+            os.truncate(segments_path, rows * row_bytes)
+
+        with open(labels_path, "rb") as file:
+            lines = file.readlines()[:rows + 1]
+        if os.path.getsize(labels_path) > sum(len(line) for line in lines):
+            with open(labels_path, "wb") as file:
+                file.writelines(lines)
+
+    """
+    return:
+        no. of rows of the dataset
+    """
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    """
+    This function appends segments to the dataset.
+    params:
+        segments -> array of segments of the width (and no. of leads) of
+                    the dataset
+        labels -> id of the patient of each segment, or one id for all of
+                  them
+    return: None
+    """
+
+    def write(self, segments, labels):
+        segments = np.ascontiguousarray(segments, dtype=np.float32)
+        if segments.shape[1:] != self.shape:
+            raise ValueError("Segments of shape %s can not be written to a dataset of "
+                             "shape %s." % (segments.shape[1:], self.shape))
+
+        if np.ndim(labels) == 0:
+            labels = [labels] * len(segments)
+        labels = np.asarray(labels).astype(str)
+        if len(labels) != len(segments):
+            raise ValueError("There must be one label per segment.")
+
+        if len(segments) == 0:
+            return
+
+        segments.tofile(self.segments_file)
+        self.segments_file.flush()
+        pd.DataFrame({"label": labels}).to_csv(self.labels_file, header=False,
+                                               index=False)
+        self.labels_file.flush()
+
+        self.patients.update(labels.tolist())
+        self.meta["rows"] += len(segments)
+        write_meta(self.path, self.meta)
+
+    """
+    This function closes the files of the dataset.
+    return: None
+    """
+
+    def close(self):
+        self.segments_file.close()
+        self.labels_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+"""
+This function encodes the labels as integers.
+params:
+    labels -> id of the patient of each segment
+return:
+    sorted array of distinct labels and the position of each label in it
+"""
+
+def encode_labels(labels):
+    classes, encoded = np.unique(np.asarray(labels).astype(str), return_inverse=True)
+    return classes, encoded.astype(np.int32)
+
+
+"""
+This class gives batches of segments and integer labels from a dataset,
+reading only the rows of each batch. The rows are shuffled every epoch and
+the next batches are read by a background thread while the current one is
+being used, so that disk and cpu work at the same time. Only `prefetch`
+batches are held in memory at a time.
+params:
+    segments -> array of segments (usually memory mapped)
+    labels -> integer label of each segment
+    rows -> rows of the dataset to use, defaults to all of them
+    batch_size -> no. of segments in each batch
+    shuffle -> if True the rows are shuffled every epoch
+    prefetch -> no. of batches read ahead
+    repeat -> if True batches are given for ever, epoch after epoch
+    seed -> seed of the random generator used to shuffle
+"""
+
+class BatchLoader:
+    def __init__(self, segments, labels, rows=None, batch_size=32, shuffle=True,
+                 prefetch=4, repeat=True, seed=None):
+        self.segments = segments
+        self.labels = np.asarray(labels)
+        self.rows = np.arange(len(segments)) if rows is None else np.asarray(rows)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.repeat = repeat
+        self.rng = np.random.default_rng(seed)
+
+    """
+    return:
+        no. of batches in one epoch
+    """
+
+    def __len__(self):
+        return -(-len(self.rows) // self.batch_size)
+
+    """
+    This function reads one batch. The rows are read in increasing order
+    which is faster for memory mapped data.
+    params:
+        rows -> rows of the batch
+    return:
+        segments of the batch with a channel axis and their labels
+    """
+
+    def read_batch(self, rows):
+        rows = np.sort(rows)
+        X = np.asarray(self.segments[rows], dtype=np.float32)
+        if X.ndim == 2:
+            X = X[..., np.newaxis]
+        return X, self.labels[rows]
+
+    """
+    This function gives the batches of every epoch. It is run by the
+    background thread.
+    """
+
+    def batches(self):
+        while True:
+            rows = self.rng.permutation(self.rows) if self.shuffle else self.rows
+
+            for start in range(0, len(rows), self.batch_size):
+                yield self.read_batch(rows[start : start + self.batch_size])
+
+            if not self.repeat:
+                return
+
+    """
+    This function starts the background thread and gives the batches it
+    reads. The thread stops when the iteration is stopped.
+    """
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for batch in self.batches():
+                    while not stop.is_set():
+                        try:
+                            queue.put(batch, timeout=0.1)
+                            break
+                        except Full:
+                            pass
+                    if stop.is_set():
+                        return
+                queue.put(done)
+            except BaseException as error:
+                queue.put(error)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                batch = queue.get()
+                if batch is done:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
@@ -5,13 +5,21 @@ level and mother wavelet `db5`, we find a level below which we need
 to de-noise the signal. Then the signal is de-noised using soft
 thresholding. Finally the signal is smotheened further to remove noise
 left after previous steps.
+Signals of several leads are given as a 2-D array with one column per
+lead. Internally the leads are the rows of a 2-D array, which are
+decomposed and reconstructed in one call, while every row gets its own
+energies, thresholds and level. `denoise_batch` stacks short signals of
+the same length in the same way, so that many records or windows are
+processed in a few calls.
 """
 
-import copy
-
 import numpy as np
 import pywt
 
+import load_data
+import metrics
+import pipeline
+
 
 """
 This function is used to calculate energy of each level of DWT.
@@ -19,14 +27,15 @@ params:
     level -> the level in DWT whose cofficients are being taken
              into account
 return:
-    energy corresponding to the layer
+    energy corresponding to the layer, one per row for 2-D levels
 """
 
 def calc_energy(level):
-    res = 0.0
-    for coff in level:
-        res += coff*coff
-    
+    if level.ndim == 1:
+        res = np.dot(level, level)
+    else:
+        res = np.einsum("ij,ij->i", level, level)
+
     res = np.log(res)
     return res
 
@@ -38,12 +47,12 @@ params:
              into account
     n -> number of samples
 return:
-    threshold value for each level
+    threshold value for each level, one per row for 2-D levels
 """
 
 def calc_threshold(level, n):
     tmp = np.absolute(level)
-    md = np.median(tmp)
+    md = np.median(tmp, axis=-1)
 
     sigma = md/0.6745
     res = sigma * np.sqrt(2.0 * np.log10(n))
@@ -114,68 +123,58 @@ def find_denoise_level(energy):
 
 """
 This function is used to smooth the signal to further remove noises.
+Every sample lying between the lowest local maxima and the highest local
+minima is averaged with those of its neighbours which lie in the same
+range.
 params:
-    signal -> signal which needs to be smotheened
+    signal -> signal which needs to be smotheened, or 2-D array with one
+              signal per row
 return:
     smooth signal
 """
 
 def smooth(signal):
-    n = len(signal)
-    res = []; lmaxs = []; upmins = []
-    
-    for i in range(1,n-1):
-        pre = signal[i-1]
-        cur = signal[i]
-        nex = signal[i+1]
-
-        if cur < pre and cur < nex:
-            upmins.append(cur)
-        if cur > pre and cur > nex:
-            lmaxs.append(cur)
+    signal = np.asarray(signal)
+
+    pre = signal[..., :-2]
+    cur = signal[..., 1:-1]
+    nex = signal[..., 2:]
+
+    is_min = (cur < pre) & (cur < nex)
+    is_max = (cur > pre) & (cur > nex)
 
     # first we find the lowest local maxima
-    # and highest local minima
-
-    lmax = np.amin(lmaxs)
-    upmin = np.amax(upmins)
-
-    if lmax < upmin:
-        lmax, upmin = upmin, lmax
-
-
-    res.append(signal[0])
-    for i in range(1,n-1):
-        pre = signal[i-1]
-        cur = signal[i]
-        nex = signal[i+1]
-
-
-        if upmin <= cur and cur <= lmax:
-            # case 1: when all 3 samples lie between lmax and upmin
-            if (upmin <= pre and pre <= lmax) and \
-               (upmin <= nex and nex <= lmax):
-                res.append((pre+cur+nex)/3)
-            
-            # case 2: when nex does not lie between lmax and upmin
-            if (upmin <= pre and pre <= lmax) and \
-               (not (upmin <= nex and nex <= lmax)):
-                res.append((pre+cur)/2)
-            
-            # case 3: when pre does not lie between lmax and upmin
-            if (not (upmin <= pre and pre <= lmax)) and \
-               (upmin <= nex and nex <= lmax):
-                res.append((nex+cur)/2)
-            
-            # case 4: when none of the pre or nex lie between lmax and upmin
-            if (not (upmin <= pre and pre <= lmax)) and \
-               (not (upmin <= nex and nex <= lmax)):
-                res.append(cur)
+    # and highest local minima of each row
 
-        else:
-            res.append(cur)
+    lmax = np.amin(np.where(is_max, cur, np.inf), axis=-1, keepdims=True)
+    upmin = np.amax(np.where(is_min, cur, -np.inf), axis=-1, keepdims=True)
+
+    swap = lmax < upmin
+    lmax, upmin = np.where(swap, upmin, lmax), np.where(swap, lmax, upmin)
+
+    inside = (upmin <= signal) & (signal <= lmax)
+    pre_in = inside[..., :-2]
+    cur_in = inside[..., 1:-1]
+    nex_in = inside[..., 2:]
+
+    res = signal.copy()
+    mid = res[..., 1:-1]
+
+    # case 1: when all 3 samples lie between lmax and upmin
+    mask = cur_in & pre_in & nex_in
+    mid[mask] = (pre[mask] + cur[mask] + nex[mask]) / 3
+
+    # case 2: when nex does not lie between lmax and upmin
+    mask = cur_in & pre_in & ~nex_in
+    mid[mask] = (pre[mask] + cur[mask]) / 2
+
+    # case 3: when pre does not lie between lmax and upmin
+    mask = cur_in & ~pre_in & nex_in
+    mid[mask] = (nex[mask] + cur[mask]) / 2
+
+    # case 4: when none of the pre or nex lie between lmax and upmin,
+    # the sample is kept as it is
 
-    res.append(signal[n-1])
     return res
 
 
@@ -186,7 +185,8 @@ it converts the coffs back to signal and returns the same
 params:
     coffs -> cofficients of DWT
     levels -> levels of DWT
-    denoise_loc -> level below which we need to denoise signal
+    denoise_loc -> level below which we need to denoise signal, one per
+                   row for 2-D cofficients
     thresh -> list of thresholds of each level
     wavelet -> wavelet used as mother wavelet (This is used to reconstruct 
                signal)
@@ -195,62 +195,169 @@ return:
 """
 
 def soft_thresh(coffs, levels, denoise_loc, thresh, wavelet):
-    soft_coff = copy.deepcopy(coffs)
+    # only the thresholded levels are replaced, the rest are shared with
+    # `coffs` instead of being copied
+    soft_coff = list(coffs)
 
-    st = levels - denoise_loc + 2
+    st = levels - np.asarray(denoise_loc) + 2
     en = levels + 1
 
-    for i in range(st, en):
-        for pos in range(0, len(soft_coff[i])):
-
-            coff = soft_coff[i][pos]
+    for i in range(int(np.min(st)), en):
+        coff = coffs[i]
+        # thresholds of the rows are broadcast along them
+        t = np.asarray(thresh[i-1])[..., np.newaxis]
+        shrunk = np.maximum(np.absolute(coff) - t, 0.0)
+        soft_coff[i] = np.sign(coff) * shrunk
 
-            if abs(coff) < thresh[i-1]:
-                soft_coff[i][pos] = 0
-            else:
-                soft_coff[i][pos] = (np.sign(coff) * (abs(coff) - thresh[i-1]))
+        # rows whose level is lower keep this level as it is
+        if st.ndim > 0 and np.any(i < st):
+            soft_coff[i] = np.where((i >= st)[:, np.newaxis], soft_coff[i], coff)
 
     signal = pywt.waverec(soft_coff, wavelet)
     return signal
 
 
 """
-This function is used to denoise the signals so that they can be processed 
-easily by the model.
-params: None
+This function is used to denoise a signal, or several signals of the same
+length given as the rows of a 2-D array. Each signal is centred, decomposed
+using DWT, soft thresholded below the level found by `find_denoise_level`
+and finally smotheened.
+params:
+    rows -> signal which needs to be denoised, or 2-D array with one
+            signal per row
+    plan -> pipeline plan holding the wavelet and levels of the DWT, the
+            default one if None
+return:
+    denoised signals
+"""
+
+def denoise_rows(rows, plan=None):
+    if plan is None:
+        plan = pipeline.get_plan(None)
+    wavelet = plan.wavelet
+    levels = plan.levels
+
+    s_avg = np.mean(rows, axis=-1, dtype=np.float64, keepdims=rows.ndim > 1)
+    rows = rows - s_avg
+
+    coffs = pywt.wavedec(rows, wavelet, level=levels)
+
+    energy = []
+    thresh = []
+
+    for level in coffs[1:]:
+        energy.append(calc_energy(level))
+        thresh.append(calc_threshold(level, rows.shape[-1]))
+
+    energy.reverse()
+
+    if rows.ndim == 1:
+        denoise_loc = find_denoise_level(energy)
+    else:
+        denoise_loc = np.array([find_denoise_level(row)
+                                for row in np.transpose(energy)])
+
+    rows = soft_thresh(coffs, levels, denoise_loc, thresh, wavelet)
+    rows = smooth(rows)
+    return rows
+
+
+"""
+This function is used to denoise a single signal.
+params:
+    signal -> signal which needs to be denoised, or 2-D array with one
+              lead per column
+    plan -> pipeline plan, the default one if None
+return:
+    denoised signal
+"""
+
+def denoise_signal(signal, plan=None):
+    signal = np.asarray(signal)
+    if signal.ndim == 1:
+        return denoise_rows(signal, plan)
+
+    # leads are denoised as contiguous rows, which is much faster
+    rows = np.ascontiguousarray(signal.T)
+    return denoise_rows(rows, plan).T
+
+
+"""
+This function gives the batches in which signals are denoised together.
+Signals of the same shape are stacked as long as the batch holds at most
+`batch_samples` samples. Only short signals gain from being stacked, e.g.
+windows of a few seconds, while batches much larger than the cpu cache are
+slower than denoising the signals one by one, so that signals longer than
+`batch_samples` are always denoised on their own.
+params:
+    signals -> list of signals, or 2-D arrays with one lead per column
+    batch_samples -> max no. of samples denoised together
+return:
+    list of batches, each of which is a list of positions in `signals`
+"""
+
+def batches(signals, batch_samples=2**17):
+    # signals of the same shape, in their original order
+    groups = {}
+    for idx, signal in enumerate(signals):
+        groups.setdefault(np.shape(signal), []).append(idx)
+
+    res = []
+    for shape, members in groups.items():
+        size = max(batch_samples // max(int(np.prod(shape)), 1), 1)
+        res.extend(members[start : start + size]
+                   for start in range(0, len(members), size))
+
+    return res
+
+
+"""
+This function is used to denoise signals of the same shape together, as
+the rows of a 2-D array, each of them still getting its own denoise level.
+params:
+    signals -> list of signals of the same shape, or 2-D arrays with one
+               lead per column
+    plan -> pipeline plan, the default one if None
 return: list of denoised signals
 """
 
-def denoise(datasets):
-    denoised = []
+def denoise_batch(signals, plan=None):
+    if len(signals) == 1:
+        return [denoise_signal(signals[0], plan)]
 
-    idx = 1
-    for dataset in datasets:
-        print("Removing high frequency noise from patient", idx, "data", end = '\r')
-        idx += 1
+    leads = 1 if np.ndim(signals[0]) == 1 else np.shape(signals[0])[1]
+    rows = np.concatenate([np.atleast_2d(np.asarray(signal).T) for signal in signals])
+    rows = denoise_rows(rows, plan)
 
-        signal = dataset["lead1"]
+    return [rows[pos] if leads == 1 else rows[pos * leads : (pos + 1) * leads].T
+            for pos in range(len(signals))]
 
-        s_avg = np.mean(signal, dtype=np.float64)
-        signal = signal - s_avg
 
-        levels = 10
-        wavelet = "db5"
-        coffs = pywt.wavedec(signal, wavelet, level=levels)
+"""
+This function is used to denoise the signals so that they can be processed 
+easily by the model. Signals of the same length are denoised together in
+the batches given by `batches`.
+params:
+    datasets -> list of datasets
+    leads -> no. of leads denoised, the signals are 2-D arrays with one
+             lead per column if more than one
+    batch_samples -> max no. of samples denoised together, see `batches`
+    plan -> pipeline plan, the default one if None
+return: list of denoised signals
+"""
 
-        energy = []
-        thresh = []
+def denoise(datasets, leads=1, batch_samples=2**17, plan=None):
+    signals = [load_data.lead_matrix(dataset, leads) for dataset in datasets]
 
-        for level in coffs[1:]:
-            energy.append(calc_energy(level))
-            thresh.append(calc_threshold(level, len(signal)))
+    denoised = [None] * len(signals)
+    done = 0
 
-        energy.reverse()
+    for ids in batches(signals, batch_samples):
+        metrics.progress("Removing high frequency noise from patient", done + 1, "data")
 
-        denoise_loc = find_denoise_level(energy)
+        for idx, res in zip(ids, denoise_batch([signals[idx] for idx in ids], plan)):
+            denoised[idx] = res
 
-        signal = soft_thresh(coffs, levels, denoise_loc, thresh, wavelet)
-        signal = smooth(signal)
-        denoised.append(signal)
+        done += len(ids)
 
     return denoised
\ No newline at end of file
@@ -0,0 +1,268 @@
+"""
+This script is used to identify subjects by comparing embeddings of their
+heartbeats instead of classifying them with the softmax layer of the model.
+Every enrolled subject is represented by a template, the normalised mean of
+the embeddings of its segments. A recording is identified by the template
+with the highest cosine similarity to its own mean embedding. Enrolling a
+new subject only adds a template, the model does not need to be retrained.
+For large galleries the templates can be clustered (IVF i.e. inverted file
+index), so that only the templates of the clusters closest to the query are
+compared with it.
+"""
+
+import numpy as np
+
+
+"""
+This function scales the rows of an array to unit length.
+params:
+    vectors -> 2-D array
+return:
+    array with rows of unit length
+"""
+
+def normalise_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+"""
+This function finds the `k` largest values of each row.
+params:
+    scores -> 2-D array
+    k -> no. of values to find
+return:
+    columns of the largest values of each row, in decreasing order
+"""
+
+def top_k(scores, k):
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+"""
+This class stores the templates of the enrolled subjects and searches them.
+params:
+    dim -> size of the embeddings
+"""
+
+class EmbeddingIndex:
+    def __init__(self, dim):
+        self.dim = dim
+        self.labels = []
+        self.positions = {}
+
+        # templates are kept in a buffer which grows by doubling, so that
+        # enrolling subjects one by one does not copy all the templates
+        self.buffer = np.zeros((16, dim), dtype=np.float32)
+        self.cluster_buffer = np.full(16, -1, dtype=np.int64)
+
+        # coarse quantizer, see `train_ivf`
+        self.centroids = None
+        # templates sorted by cluster and the bounds of each cluster in
+        # them, built when needed by `inverted_lists`
+        self.lists = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def templates(self):
+        return self.buffer[:len(self.labels)]
+
+    @property
+    def assignments(self):
+        return self.cluster_buffer[:len(self.labels)]
+
+    """
+    This function enrols a subject. If the subject is already enrolled its
+    template is replaced.
+    params:
+        label -> id of the subject
+        embeddings -> 2-D array of embeddings of the segments of the subject
+    return: None
+    """
+
+    def enrol(self, label, embeddings):
+        embeddings = normalise_rows(embeddings)
+        template = normalise_rows(embeddings.mean(axis=0, keepdims=True))
+
+        label = str(label)
+        if label in self.positions:
+            pos = self.positions[label]
+        else:
+            pos = len(self.labels)
+            if pos == len(self.buffer):
+                grow = max(len(self.buffer), 16)
+                self.buffer = np.concatenate(
+                    (self.buffer, np.zeros((grow, self.dim), dtype=np.float32)))
+                self.cluster_buffer = np.concatenate(
+                    (self.cluster_buffer, np.full(grow, -1, dtype=np.int64)))
+
+            self.positions[label] = pos
+            self.labels.append(label)
+
+        self.buffer[pos] = template[0]
+
+        if self.centroids is not None:
+            self.cluster_buffer[pos] = int(np.argmax(self.centroids @ template[0]))
+            self.lists = None
+
+    """
+    This function clusters the templates using spherical k-means so that
+    searches only compare the query with the templates of a few clusters.
+    params:
+        n_lists -> no. of clusters
+        iterations -> no. of iterations of k-means
+        seed -> seed of the random generator
+    return: None
+    """
+
+    def train_ivf(self, n_lists, iterations=10, seed=0):
+        n_lists = min(n_lists, len(self))
+        rng = np.random.default_rng(seed)
+
+        centroids = self.templates[rng.choice(len(self), n_lists, replace=False)]
+
+        for _ in range(iterations):
+            assignments = np.argmax(self.templates @ centroids.T, axis=1)
+
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, self.templates)
+            counts = np.bincount(assignments, minlength=n_lists)
+
+            # empty clusters keep their centroid
+            empty = counts == 0
+            sums[empty] = centroids[empty]
+            centroids = normalise_rows(sums)
+
+        self.centroids = centroids
+        self.assignments[:] = np.argmax(self.templates @ centroids.T, axis=1)
+        self.lists = None
+
+    """
+    This function gives the templates of each cluster.
+    return:
+        positions of the templates sorted by cluster and the bounds of
+        each cluster in them
+    """
+
+    def inverted_lists(self):
+        if self.lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            bounds = np.searchsorted(self.assignments[order],
+                                     np.arange(len(self.centroids) + 1))
+            self.lists = (order, bounds)
+
+        return self.lists
+
+    """
+    This function finds the enrolled subjects closest to the queries.
+    params:
+        queries -> 2-D array of embeddings
+        k -> no. of subjects to find for each query
+        nprobe -> no. of clusters searched for each query if the index has
+                  been clustered, all the templates are searched if None
+    return:
+        list of labels and 2-D array of cosine similarities of the `k`
+        closest subjects of each query
+    """
+
+    def search(self, queries, k=1, nprobe=None):
+        queries = normalise_rows(queries)
+        k = min(k, len(self))
+
+        if k == 0:
+            return [[] for _ in queries], np.zeros((len(queries), 0), dtype=np.float32)
+
+        if self.centroids is None or nprobe is None:
+            scores = queries @ self.templates.T
+            best = top_k(scores, k)
+            similarity = np.take_along_axis(scores, best, axis=1)
+            labels = [[self.labels[pos] for pos in row] for row in best]
+            return labels, similarity
+
+        probes = top_k(queries @ self.centroids.T, nprobe)
+        order, bounds = self.inverted_lists()
+
+        labels = []
+        similarity = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        for row, query in enumerate(queries):
+            candidates = np.concatenate([order[bounds[c] : bounds[c + 1]]
+                                         for c in probes[row]])
+            if len(candidates) == 0:
+                labels.append([])
+                continue
+
+            scores = self.templates[candidates] @ query
+            best = top_k(scores[np.newaxis], k)[0]
+
+            labels.append([self.labels[candidates[pos]] for pos in best])
+            similarity[row, :len(best)] = scores[best]
+
+        return labels, similarity
+
+    """
+    This function identifies the subject of a recording from the
+    embeddings of its segments.
+    params:
+        embeddings -> 2-D array of embeddings of the segments
+        nprobe -> see `search`
+    return:
+        label of the closest subject and its cosine similarity
+    """
+
+    def identify(self, embeddings, nprobe=None):
+        query = normalise_rows(embeddings).mean(axis=0, keepdims=True)
+        labels, similarity = self.search(query, 1, nprobe)
+
+        if not labels[0]:
+            return None, float("-inf")
+        return labels[0][0], float(similarity[0, 0])
+
+    """
+    This function saves the index.
+    params:
+        path -> file in which the index is saved
+    return: None
+    """
+
+    def save(self, path):
+        arrays = {
+            "templates": self.templates,
+            "labels": np.asarray(self.labels, dtype=str),
+        }
+        if self.centroids is not None:
+            arrays["centroids"] = self.centroids
+            arrays["assignments"] = self.assignments
+
+        with open(path, "wb") as file:
+            np.savez(file, **arrays)
+
+    """
+    This function loads an index saved by `save`.
+    params:
+        path -> file containing the index
+    return:
+        the loaded index
+    """
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            templates = arrays["templates"]
+            index = cls(templates.shape[1])
+            index.buffer = np.array(templates, dtype=np.float32)
+            index.cluster_buffer = np.full(len(templates), -1, dtype=np.int64)
+            index.labels = arrays["labels"].tolist()
+            index.positions = {label: pos for pos, label in enumerate(index.labels)}
+
+            if "centroids" in arrays:
+                index.centroids = arrays["centroids"]
+                index.cluster_buffer[:] = arrays["assignments"]
+
+        return index
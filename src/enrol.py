@@ -0,0 +1,91 @@
+"""
+This script is used to enrol subjects in the embedding index used by
+`identify.py --index`. The recordings of a subject go through the usual
+preprocessing chain and the embeddings of their segments, given by the
+trained model, are averaged into the template of the subject. No training
+is needed, so a new subject can be enrolled in a few milliseconds once its
+recordings are preprocessed.
+Usage:
+    python enrol.py subject_id record_or_directory [record_or_directory ...]
+"""
+
+import argparse
+import os
+import time
+
+# the model is only used for inference, which is run on the cpu as in
+# `identify.py`
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+
+import keras
+import numpy as np
+
+import embedding_index
+import identify
+import pipeline
+
+
+"""
+This is the driver function which enrols a subject from its records and
+saves the updated index.
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Enrol a subject in the embedding index.")
+    parser.add_argument("subject", help="id of the subject")
+    parser.add_argument("inputs", nargs="+",
+                        help="records or directories containing records")
+    parser.add_argument("--model", default="../trained_model.keras")
+    parser.add_argument("--index", default="../embedding_index.npz")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="no. of seconds used from the start of each record")
+    parser.add_argument("--ivf-lists", type=int, default=None,
+                        help="cluster the templates into this many lists "
+                             "after enrolling")
+    parser.add_argument("--config", default=None,
+                        help="json file with the parameters of the "
+                             "preprocessing stages used for the training data")
+    args = parser.parse_args()
+
+    config = None
+    if args.config is not None:
+        config = pipeline.PipelineConfig.load(args.config)
+
+    model = identify.embedding_model(keras.models.load_model(args.model))
+    width, leads = model.input_shape[1:3]
+
+    segments = []
+    for path in identify.find_records(args.inputs):
+        segs = identify.record_segments(path, width, args.duration, leads, config)
+        if len(segs) == 0:
+            print("Skipped %s, no segments found" %(path))
+            continue
+        segments.append(segs)
+
+    if not segments:
+        raise ValueError("No segments found in the records of %s." %(args.subject))
+
+    segments = np.concatenate(segments)
+
+    embeddings = model.predict(identify.model_inputs(segments), verbose=0)
+
+    if os.path.exists(args.index):
+        index = embedding_index.EmbeddingIndex.load(args.index)
+    else:
+        index = embedding_index.EmbeddingIndex(embeddings.shape[1])
+
+    start = time.perf_counter()
+    index.enrol(args.subject, embeddings)
+    elapsed = time.perf_counter() - start
+
+    if args.ivf_lists is not None:
+        index.train_ivf(args.ivf_lists)
+
+    index.save(args.index)
+
+    print("Enrolled %s from %d segments in %.3f ms, %d subjects enrolled" %(
+          args.subject, len(segments), elapsed * 1000.0, len(index)))
+
+
+if __name__ == "__main__":
+    main()
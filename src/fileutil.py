@@ -0,0 +1,39 @@
+"""
+This script holds the helpers used to write the files which are shared by
+several processes, e.g. the record index, the stage cache, the meta data
+of a dataset and the files of the work queue. A file is written to a
+temporary file of its own in the same folder and then renamed over the
+file, so that readers either see the whole old file or the whole new one.
+"""
+
+import os
+import tempfile
+
+
+"""
+This function writes a file atomically. The temporary file is removed if
+the file cannot be written.
+params:
+    path -> file to write
+    write -> function writing the content to the file it is given
+    mode -> mode in which the file is opened, `wb` or `w`
+return:
+    the value returned by `write`
+"""
+
+def write_atomic(path, write, mode="wb"):
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        with os.fdopen(fd, mode) as file:
+            res = write(file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        raise
+
+    return res
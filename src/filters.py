@@ -0,0 +1,113 @@
+"""
+This script is used to filter long recordings in chunks, so that the memory
+used by the filters depends on the size of the chunks and not on the length
+of the recording. Filters are given as second order sections (sos), which
+are numerically more stable than the (b, a) form for low cutoff
+frequencies. The state of the filter is carried from one chunk to the next,
+so the result is the same as filtering the whole signal at once. The input
+can be any array which can be sliced, e.g. a memory mapped record, and is
+only read one chunk at a time. Signals of several leads are given as 2-D
+arrays with one lead per column and are filtered along the first axis.
+"""
+
+import numpy as np
+from scipy.signal import sosfilt, sosfilt_zi
+
+
+# no. of samples filtered at a time
+CHUNK_SIZE = 2**18
+
+
+"""
+This function applies a causal filter to a signal chunk by chunk, like
+`scipy.signal.sosfilt`.
+params:
+    sos -> second order sections of the filter
+    signal -> 1-D signal or 2-D array with one lead per column, may be
+              memory mapped
+    zi -> initial state of the filter, zero if None
+    chunk_size -> no. of samples filtered at a time
+    out -> array in which the result is written, e.g. a memory mapped
+           file. It can be the signal itself. A new array is allocated if
+           None.
+return:
+    filtered signal and final state of the filter
+"""
+
+def sos_filter(sos, signal, zi=None, chunk_size=CHUNK_SIZE, out=None):
+    n = len(signal)
+    if out is None:
+        out = np.empty(signal.shape)
+    if zi is None:
+        zi = np.zeros((len(sos), 2) + signal.shape[1:])
+
+    for start in range(0, n, chunk_size):
+        chunk = np.asarray(signal[start : start + chunk_size], dtype=np.float64)
+        out[start : start + len(chunk)], zi = sosfilt(sos, chunk, axis=0, zi=zi)
+
+    return out, zi
+
+
+"""
+This function gives the length of the odd extension which
+`scipy.signal.sosfiltfilt` adds at both ends of the signal.
+params:
+    sos -> second order sections of the filter
+return:
+    no. of samples added at each end
+"""
+
+def pad_length(sos):
+    ntaps = 2 * len(sos) + 1
+    ntaps -= min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    return 3 * ntaps
+
+
+"""
+This function applies a zero phase filter to a signal chunk by chunk, like
+`scipy.signal.sosfiltfilt`. The signal is filtered forwards into `out`
+chunk by chunk and then backwards in place, starting from the last chunk.
+Both ends are extended as in `sosfiltfilt` and the initial states are
+computed in the same way, so the result matches it.
+params:
+    sos -> second order sections of the filter
+    signal -> 1-D signal or 2-D array with one lead per column, may be
+              memory mapped
+    chunk_size -> no. of samples filtered at a time
+    out -> array in which the result is written, see `sos_filter`
+return:
+    filtered signal
+"""
+
+def sos_filtfilt(sos, signal, chunk_size=CHUNK_SIZE, out=None):
+    n = len(signal)
+    edge = pad_length(sos)
+
+    if n <= edge:
+        raise ValueError("The length of the signal must be larger than %d "
+                         "samples to be filtered." % edge)
+
+    # odd extension of both ends of the signal
+    head = np.asarray(signal[:edge + 1], dtype=np.float64)
+    tail = np.asarray(signal[-edge - 1:], dtype=np.float64)
+    left = 2 * head[0] - head[edge:0:-1]
+    right = 2 * tail[-1] - tail[-2::-1]
+
+    # initial state for a constant input, one per lead
+    zi = sosfilt_zi(sos).reshape((len(sos), 2) + (1,) * (head.ndim - 1))
+
+    # forward pass over the extended signal
+    _, state = sosfilt(sos, left, axis=0, zi=zi * left[0])
+    out, state = sos_filter(sos, signal, state, chunk_size, out)
+    right, _ = sosfilt(sos, right, axis=0, zi=state)
+
+    # backward pass, the ends are only needed for the state of the filter
+    _, state = sosfilt(sos, right[::-1], axis=0, zi=zi * right[-1])
+
+    for end in range(n, 0, -chunk_size):
+        start = max(end - chunk_size, 0)
+        chunk = np.asarray(out[start:end], dtype=np.float64)[::-1]
+        filtered, state = sosfilt(sos, chunk, axis=0, zi=state)
+        out[start:end] = filtered[::-1]
+
+    return out
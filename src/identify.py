@@ -0,0 +1,323 @@
+"""
+This script is used to identify the subjects of new ECG recordings using the
+trained model. Each recording goes through the same chain as the training
+data (cleaning, peak detection, segmentation and normalisation) and every
+segment is classified. The subject of a recording is the patient which gets
+the most votes from its segments.
+Segments of several recordings are classified together in large batches so
+that the model is called only a few times. Everything runs on the cpu.
+Usage:
+    python identify.py record_or_directory [record_or_directory ...]
+Records can be given as wfdb records (with or without the `.hea`/`.dat`
+extension) or as files of the binary record store.
+With `--index` the softmax layer is not used. Instead each recording is
+matched against the templates of the subjects enrolled with `enrol.py`
+using the output of the layer before it as the embedding of a segment.
+"""
+
+import argparse
+import json
+import os
+import time
+
+# the model is only used for inference, which is run on the cpu
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+
+import keras
+import numpy as np
+import wfdb as wf
+
+import clean_signal
+import embedding_index
+import load_data
+import peak_detection
+import pipeline
+import preprocess
+import record_store
+
+
+"""
+This function finds all the records given on the command line.
+params:
+    inputs -> paths of records or of directories containing records
+return:
+    list of paths of records
+"""
+
+def find_records(inputs):
+    records = []
+
+    for path in inputs:
+        if os.path.isdir(path):
+            names = sorted(os.listdir(path))
+            records += [os.path.join(path, name[:-4]) for name in names
+                        if name.endswith(".hea")]
+            records += [os.path.join(path, name) for name in names
+                        if name.endswith(record_store.EXTENSION)]
+        elif path.endswith(".hea") or path.endswith(".dat"):
+            records.append(path[:-4])
+        else:
+            records.append(path)
+
+    # a record may be given once as `.hea` and once as `.dat`
+    return list(dict.fromkeys(records))
+
+
+"""
+This function reads the first leads of a record.
+params:
+    path -> path of the record
+    duration -> no. of seconds to read from the start, all if None
+    leads -> no. of leads to read
+return:
+    sampling frequency and signal of the record, a 2-D array with one lead
+    per column if more than one lead is read
+"""
+
+def read_record(path, duration=None, leads=1):
+    if path.endswith(record_store.EXTENSION):
+        record = record_store.StoredRecord(path)
+        if duration is not None:
+            record = record.window(0, int(duration * record.fs))
+        return record.fs, np.asarray(load_data.lead_matrix(record, leads))
+
+    header = wf.rdheader(path)
+    sampto = None
+    if duration is not None:
+        sampto = min(int(duration * header.fs), header.sig_len)
+
+    record = wf.rdrecord(path, sampto=sampto, channels=list(range(leads)))
+    signal = record.p_signal
+    return record.fs, signal[:, 0] if leads == 1 else signal
+
+
+"""
+This function runs the preprocessing chain on a record.
+params:
+    path -> path of the record
+    width -> no. of samples in each segment, as expected by the model
+    duration -> no. of seconds to read from the start, all if None
+    leads -> no. of leads, i.e. channels expected by the model
+    config -> pipeline configuration used to preprocess the training data,
+              the default one if None
+return:
+    array of segments of the record, which is empty for records too short
+    to be filtered or to hold a segment
+"""
+
+def record_segments(path, width, duration=None, leads=1, config=None):
+    fs, signal = read_record(path, duration, leads)
+    plan = pipeline.get_plan(fs, config)
+
+    if preprocess.too_short(signal, plan, width):
+        return np.zeros((0, width) + signal.shape[1:])
+
+    signal = clean_signal.clean_record(signal, fs, plan)
+    peaks = peak_detection.detect_peaks(preprocess.first_lead(signal), fs, plan)
+
+    return preprocess.segment(signal, peaks, width=width, plan=plan)
+
+
+"""
+This function gives segments in the shape expected by the model.
+params:
+    segments -> array of segments
+return:
+    segments with a channel axis
+"""
+
+def model_inputs(segments):
+    return segments[..., np.newaxis] if segments.ndim == 2 else segments
+
+
+"""
+This function gives a model which outputs the embedding of a segment i.e.
+the output of the `Dense(32)` layer which comes before the softmax layer.
+params:
+    model -> trained model created by `train_model.make_model`
+return:
+    the embedding model
+"""
+
+def embedding_model(model):
+    return keras.Model(inputs=model.inputs, outputs=model.layers[-2].output)
+
+
+"""
+This function classifies the segments of several records in one call of
+the model and finds the subject of each record by majority vote.
+params:
+    model -> the trained model
+    classes -> patient id of each output of the model
+    pending -> list of (path, segments, start time) of the records
+    batch_size -> no. of segments given to the model at a time
+return:
+    list of results of the records
+"""
+
+def classify(model, classes, pending, batch_size):
+    segments = np.concatenate([item[1] for item in pending])
+    predictions = model.predict(model_inputs(segments), batch_size=batch_size,
+                                verbose=0)
+    votes = np.argmax(predictions, axis=1)
+
+    results = []
+    ptr = 0
+    end = time.perf_counter()
+
+    for path, segs, start in pending:
+        n = len(segs)
+        counts = np.bincount(votes[ptr : ptr + n], minlength=len(classes))
+        ptr += n
+
+        best = int(np.argmax(counts))
+        results.append({
+            "record": path,
+            "subject": str(classes[best]),
+            "confidence": float(counts[best] / n),
+            "segments": n,
+            "latency": end - start,
+        })
+
+    return results
+
+
+"""
+This function finds the embeddings of the segments of several records in
+one call of the model and identifies the subject of each record with the
+embedding index.
+params:
+    model -> the embedding model
+    index -> the embedding index of the enrolled subjects
+    pending -> list of (path, segments, start time) of the records
+    batch_size -> no. of segments given to the model at a time
+    nprobe -> no. of clusters of the index searched, see
+              `embedding_index.EmbeddingIndex.search`
+return:
+    list of results of the records
+"""
+
+def match(model, index, pending, batch_size, nprobe=None):
+    segments = np.concatenate([item[1] for item in pending])
+    embeddings = model.predict(model_inputs(segments), batch_size=batch_size,
+                               verbose=0)
+
+    results = []
+    ptr = 0
+    end = time.perf_counter()
+
+    for path, segs, start in pending:
+        n = len(segs)
+        subject, similarity = index.identify(embeddings[ptr : ptr + n], nprobe)
+        ptr += n
+
+        results.append({
+            "record": path,
+            "subject": subject,
+            "confidence": similarity,
+            "segments": n,
+            "latency": end - start,
+        })
+
+    return results
+
+
+"""
+This is the driver function which identifies the subjects of all the given
+records and reports the results.
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Identify the subjects of ECG records.")
+    parser.add_argument("inputs", nargs="+",
+                        help="records or directories containing records")
+    parser.add_argument("--model", default="../trained_model.keras")
+    parser.add_argument("--classes", default="../trained_model_classes.json",
+                        help="patient ids saved along with the model")
+    parser.add_argument("--batch-size", type=int, default=8192,
+                        help="no. of segments classified in one call of the model")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="no. of seconds used from the start of each record")
+    parser.add_argument("--json", default=None,
+                        help="file to which the results are written")
+    parser.add_argument("--index", default=None,
+                        help="embedding index of enrolled subjects to match "
+                             "records against instead of classifying them")
+    parser.add_argument("--nprobe", type=int, default=None,
+                        help="no. of clusters of the index to search")
+    parser.add_argument("--config", default=None,
+                        help="json file with the parameters of the "
+                             "preprocessing stages used for the training data")
+    args = parser.parse_args()
+
+    config = None
+    if args.config is not None:
+        config = pipeline.PipelineConfig.load(args.config)
+
+    model = keras.models.load_model(args.model)
+    width, leads = model.input_shape[1:3]
+
+    if args.index is None:
+        with open(args.classes) as file:
+            classes = json.load(file)
+        run = lambda pending: classify(model, classes, pending, args.batch_size)
+    else:
+        index = embedding_index.EmbeddingIndex.load(args.index)
+        model = embedding_model(model)
+        run = lambda pending: match(model, index, pending, args.batch_size, args.nprobe)
+
+    records = find_records(args.inputs)
+
+    print("============================== Model Loaded ===============================")
+
+    results = []
+    pending = []
+    n_pending = 0
+    begin = time.perf_counter()
+
+    for idx, path in enumerate(records):
+        print("Processing record", idx + 1, "of", len(records), end = '\r')
+
+        start = time.perf_counter()
+        segments = record_segments(path, width, args.duration, leads, config)
+
+        if len(segments) == 0:
+            results.append({"record": path, "subject": None, "confidence": 0.0,
+                            "segments": 0, "latency": time.perf_counter() - start})
+            continue
+
+        pending.append((path, segments, start))
+        n_pending += len(segments)
+
+        if n_pending >= args.batch_size:
+            results += run(pending)
+            pending = []
+            n_pending = 0
+
+    if pending:
+        results += run(pending)
+
+    elapsed = time.perf_counter() - begin
+
+    order = {path: idx for idx, path in enumerate(records)}
+    results.sort(key=lambda res: order[res["record"]])
+
+    print("")
+    for res in results:
+        # confidence is the share of votes or the cosine similarity
+        print("%-40s %-10s %6.2f %% of %6d segments %8.3f s" %(
+              res["record"], res["subject"], res["confidence"] * 100.0,
+              res["segments"], res["latency"]))
+
+    print("Identified %d records in %.3f s (%.3f records/s)" %(
+          len(results), elapsed, len(results) / elapsed))
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump({"records": results, "elapsed": elapsed,
+                       "records_per_second": len(results) / elapsed},
+                      file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,46 +3,405 @@ This script is used to load the signal dataset from the data folder.
 The data extracted is in csv format for easy conversion into matrix.
 This script also gives the sampling frequency of data which is used
 in pre-processing steps. 
+Data can also be loaded from the binary record store, in which case the
+records are memory mapped and the frequency is read from their header.
+`RecordPrefetcher` reads the next records in background threads while the
+current one is being processed, so that reading from disk (or network
+storage) and processing overlap.
+A time window `(start, end)` in seconds can be given to load only a part
+of a record. The store and the raw wfdb records (format `raw`) only read
+the samples of the window, so any part of a long recording can be used
+without converting it again. Windows of the raw records are measured from
+the start of the recording, while windows of the csv files and of the
+store are measured from the start of the converted part (see the
+`--window` of `raw_to_csv.py`). The time-stamps of all of them are those
+of the recording.
 """
 
 
 import os
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import wfdb as wf
 
 import paths as const
+import metrics
+import record_index
+import record_store
+
+
+"""
+This function gives where the records of a format are kept.
+params:
+    fmt -> `csv` for the csv files, `store` for the binary record store or
+           `raw` for the wfdb records
+return:
+    folder of the records and extension of their files
+"""
+
+def record_folder(fmt="csv"):
+    if fmt == "store":
+        return const.STORE_PATH, record_store.EXTENSION
+    if fmt == "raw":
+        return const.RAW_PATH, ".hea"
+    return const.CSV_PATH, ".csv"
+
+
+"""
+This function gives the ids of all the records which can be loaded.
+params:
+    fmt -> `csv`, `store` or `raw`, see `record_folder`
+return:
+    sorted list of ids
+"""
+
+def record_ids(fmt="csv"):
+    folder, extension = record_folder(fmt)
+
+    return sorted(file[:-len(extension)] for file in os.listdir(folder)
+                  if file.endswith(extension))
+
+
+"""
+This function loads the index of the Database when the records of a format
+need it, i.e. to find the frequency of csv files.
+params:
+    fmt -> `csv`, `store` or `raw`, see `record_folder`
+return:
+    the index, None if it is not needed
+"""
+
+def csv_index(fmt="csv"):
+    return record_index.load_index() if fmt == "csv" else None
+
+
+"""
+This function finds the no. of samples of a csv file from the time-stamps
+of its first and last rows, so that only the start and the end of the file
+are read.
+params:
+    path -> the csv file
+    fs -> sampling frequency of the record
+return:
+    no. of samples
+"""
+
+def csv_length(path, fs):
+    with open(path, "rb") as file:
+        file.readline()
+        first = file.readline()
+        if not first.strip():
+            return 0
+
+        file.seek(0, os.SEEK_END)
+        file.seek(max(file.tell() - 4096, 0))
+        last = [line for line in file.read().splitlines() if line.strip()][-1]
+
+    start = float(first.split(b",")[0])
+    end = float(last.split(b",")[0])
+    return int(round((end - start) * fs)) + 1
+
+
+"""
+This function gives the length of a record without reading its samples.
+It is taken from the header of stored and raw records and from the first
+and last time-stamps of csv files, which may hold only a window of the raw
+record.
+params:
+    record_id -> id of the record
+    fmt -> `csv`, `store` or `raw`, see `record_folder`
+    index -> index of the Database, used to find the frequency of csv
+             files. It is loaded if needed and not given.
+return:
+    sampling frequency and no. of samples of the record
+"""
+
+def record_length(record_id, fmt="csv", index=None):
+    if fmt == "store":
+        header = record_store.read_header(const.STORE_PATH / (record_id + record_store.EXTENSION))
+        return header["fs"], header["length"]
+
+    if fmt == "raw":
+        header = wf.rdheader(str(const.RAW_PATH / record_id))
+        return header.fs, header.sig_len
+
+    if index is None:
+        index = record_index.load_index()
+    fs = index[record_id]["fs"]
+    return fs, csv_length(const.CSV_PATH / (record_id + ".csv"), fs)
+
+
+"""
+This function converts a time window to sample indices.
+params:
+    window -> `(start, end)` in seconds, `end` may be None for the end of
+              the record. The whole record if None.
+    fs -> sampling frequency
+    length -> no. of samples of the record, if known
+return:
+    first sample and end sample (excluded, None for the end of the record)
+"""
+
+def window_samples(window, fs, length=None):
+    if window is None:
+        return 0, length
+
+    start, end = window
+    sampfrom = max(int(round(start * fs)), 0)
+    sampto = None if end is None else max(int(round(end * fs)), sampfrom)
+
+    if length is not None:
+        sampfrom = min(sampfrom, length)
+        sampto = length if sampto is None else min(sampto, length)
+
+    return sampfrom, sampto
+
+
+"""
+This function reads a window of a raw wfdb record, decoding only the
+samples of the window.
+params:
+    path -> path of the record without extension
+    window -> `(start, end)` in seconds, the whole record if None
+return:
+    sampling frequency and dataset of the window, with the time-stamps and
+    the physical samples of each lead (`lead1`, `lead2`, ...)
+"""
+
+def read_raw(path, window=None):
+    header = wf.rdheader(str(path))
+    sampfrom, sampto = window_samples(window, header.fs, header.sig_len)
+
+    names = ["time"] + ["lead%d" % (lead + 1) for lead in range(header.n_sig)]
+    dataset = np.zeros(sampto - sampfrom, dtype=[(name, np.float64) for name in names])
+    dataset["time"] = np.arange(sampfrom, sampto) / header.fs
+
+    if sampto > sampfrom:
+        record = wf.rdrecord(str(path), sampfrom=sampfrom, sampto=sampto)
+        for lead in range(header.n_sig):
+            dataset[names[lead + 1]] = record.p_signal[:, lead]
+
+    return header.fs, dataset
+
+
+"""
+This function loads the data of a single patient.
+params:
+    record_id -> id of the record
+    fmt -> `csv` to load the csv file, `store` to load the binary record
+           store or `raw` to read the wfdb record
+    index -> index of the Database, used to find the frequency of csv
+             files. It is loaded if not given.
+    mmap -> if False records of the store are read into memory instead of
+            being memory mapped
+    window -> `(start, end)` in seconds of the part of the record to load,
+              the whole record if None. It is relative to the converted
+              part for csv files and the store. Csv files are still scanned
+              up to the end of the window, but only its rows are parsed.
+return:
+    sampling frequency and dataset of the record
+"""
+
+def load_record(record_id, fmt="csv", index=None, mmap=True, window=None):
+    if fmt == "store":
+        record = record_store.StoredRecord(
+            const.STORE_PATH / (record_id + record_store.EXTENSION), mmap)
+        if window is not None:
+            record = record.window(*window_samples(window, record.fs, len(record)))
+        return record.fs, record
+
+    if fmt == "raw":
+        return read_raw(const.RAW_PATH / record_id, window)
+
+    if index is None:
+        index = record_index.load_index()
+
+    # frequencies are taken from the headers instead of the raw records
+    fs = index[record_id]['fs']
+    sampfrom, sampto = window_samples(window, fs)
+
+    names = ["time","lead1","lead2"]
+    if sampto is not None and sampto <= sampfrom:
+        return fs, np.zeros(0, dtype=[(name, np.float64) for name in names])
+
+    with warnings.catch_warnings():
+        # windows after the end of the file give no rows
+        warnings.filterwarnings("ignore", "genfromtxt: Empty input file")
+        dataset = np.genfromtxt(const.CSV_PATH / (record_id + ".csv"),
+                                delimiter=",", names=names,
+                                skip_header=1 + sampfrom,
+                                max_rows=None if sampto is None else sampto - sampfrom)
+
+    if dataset.size == 0:
+        dataset = np.zeros(0, dtype=[(name, np.float64) for name in names])
+    return fs, np.atleast_1d(dataset)
+
+
+"""
+This function gives the signals of the first leads of a dataset.
+params:
+    dataset -> dataset given by `load_record`
+    leads -> no. of leads
+return:
+    signal of the first lead if `leads` is 1, otherwise 2-D array with one
+    lead per column
+"""
+
+def lead_matrix(dataset, leads=1):
+    if leads == 1:
+        return np.asarray(dataset["lead1"])
+
+    return np.column_stack([dataset["lead%d" % (lead + 1)] for lead in range(leads)])
+
+
+"""
+This class gives the records one at a time, in the order of their ids,
+while a pool of threads reads and decodes the next ones. At most `prefetch`
+records are read ahead, and no more records are started once the size of
+the files read ahead reaches `memory_budget`, although the next record is
+always read. Records of the store are read into memory instead of being
+memory mapped unless `mmap` is True, so that the reading is done by the
+threads. The threads are stopped when the iteration is stopped.
+params:
+    ids -> ids of the records, all of them if None
+    fmt -> `csv`, `store` or `raw`, see `load_record`
+    prefetch -> max no. of records read ahead
+    memory_budget -> max size in bytes of the files read ahead, None for
+                     no limit
+    threads -> no. of reading threads, defaults to `prefetch`
+    mmap -> if True records of the store are memory mapped
+    windows -> list of `(start, end)` windows in seconds. Every window of a
+               record is given separately, in the order of the list. The
+               whole records are given if None.
+"""
+
+class RecordPrefetcher:
+    def __init__(self, ids=None, fmt="csv", prefetch=4, memory_budget=None,
+                 threads=None, mmap=False, windows=None):
+        const.find_paths(fmt=fmt)
+
+        self.ids = record_ids(fmt) if ids is None else list(ids)
+        self.windows = [None] if windows is None else list(windows)
+        self.items = [(record_id, window) for record_id in self.ids
+                      for window in self.windows]
+        self.fmt = fmt
+        self.prefetch = max(1, prefetch)
+        self.memory_budget = memory_budget
+        self.threads = threads or self.prefetch
+        self.mmap = mmap
+        self.index = None if fmt == "store" else record_index.load_index()
+
+    def __len__(self):
+        return len(self.items)
+
+    """
+    This function gives the size of the file of a record, which is used to
+    estimate the memory it needs before it is read. Raw records are
+    estimated from their `.dat` file, and windows from their share of the
+    samples of the record.
+    params:
+        record_id -> id of the record
+        window -> window of the record, see `load_record`
+    return:
+        size in bytes
+    """
+
+    def file_size(self, record_id, window=None):
+        folder, extension = record_folder(self.fmt)
+        if self.fmt == "raw":
+            extension = ".dat"
+        try:
+            size = os.path.getsize(folder / (record_id + extension))
+        except OSError:
+            return 0
+
+        if window is not None:
+            fs, length = record_length(record_id, self.fmt, self.index)
+            sampfrom, sampto = window_samples(window, fs, length)
+            size = size * (sampto - sampfrom) // max(length, 1)
+
+        return size
+
+    """
+    This function reads a record. It is run by the threads.
+    params:
+        record_id -> id of the record
+        window -> window of the record, see `load_record`
+    return:
+        sampling frequency and dataset of the record
+    """
+
+    def read(self, record_id, window=None):
+        return load_record(record_id, self.fmt, self.index, self.mmap, window)
+
+    """
+    This function gives the records, or the windows of the records.
+    return:
+        iterator of (id, sampling frequency, dataset) of the records
+    """
+
+    def __iter__(self):
+        pending = deque()
+        ahead = 0
+        next_pos = 0
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            try:
+                for _ in range(len(self.items)):
+                    # start reading the next records within the limits
+                    while next_pos < len(self.items) and len(pending) < self.prefetch:
+                        record_id, window = self.items[next_pos]
+                        size = self.file_size(record_id, window)
+                        if pending and self.memory_budget is not None \
+                           and ahead + size > self.memory_budget:
+                            break
+
+                        pending.append((record_id, size,
+                                        executor.submit(self.read, record_id, window)))
+                        ahead += size
+                        next_pos += 1
+
+                    record_id, size, future = pending.popleft()
+                    fs, dataset = future.result()
+                    ahead -= size
+
+                    yield record_id, fs, dataset
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
+
 
 """
 This is the driver function that helps to load the data.
-params: None
+params:
+    fmt -> `csv` to load the csv files or `store` to load the binary
+           record store
+    prefetch -> no. of records read ahead by `RecordPrefetcher`, records
+                of the store stay memory mapped
 return: list of datasets
 """
 
-def load_data():
-    const.find_paths()
+def load_data(fmt="csv", prefetch=4):
+    const.find_paths(fmt=fmt)
 
-    print("============================= Paths Allocated =============================")
+    metrics.message("============================= Paths Allocated =============================")
 
-    filenames = [file for file in os.listdir(const.CSV_PATH)]
     datasets = []
     freqs = []
     ids = []
 
     idx = 1
-    for filename in filenames:
-        print("Loading data for patient", idx, end = '\r')
+    for record_id, fs, dataset in RecordPrefetcher(fmt=fmt, prefetch=prefetch,
+                                                     mmap=True):
+        metrics.progress("Loading data for patient", idx)
         idx += 1
 
-        dataset = np.genfromtxt(const.CSV_PATH+filename, 
-                                delimiter=",", names=["time","lead1","lead2"], 
-                                skip_header=1)
         datasets.append(dataset)
+        freqs.append(fs)
 
-        record = wf.rdrecord(const.RAW_PATH+filename[:-4])
-        freqs.append(record.__dict__['fs'])
-
-        ids.append(filename[:-4])
+        ids.append(record_id)
 
-    
-    return [freqs, datasets, ids]
\ No newline at end of file
+    return [freqs, datasets, ids]
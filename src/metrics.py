@@ -0,0 +1,289 @@
+"""
+This script is used to instrument the pipeline. Every stage run for a
+patient is measured with `stage`, which records its wall time, cpu time,
+the peak memory (RSS) of the process at its end and the no. of bytes read
+and written during it. Counters such as the no. of beats detected and of
+segments produced are kept with `count`. Records processed in several time
+windows have their measurements labelled with the window as well. Stages
+run for several patients at once are measured with `batch_stage`, which
+gives each of them an equal share labelled with the size of the batch.
+Measurements are kept per process. Worker processes hand theirs to the
+main process with `collect` and `merge`, after which they can be exported
+as json lines (one measurement per line) or in the Prometheus text format.
+In quiet mode the progress lines printed for every patient and the
+messages marking the steps of the pipeline are dropped.
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+# quiet mode is passed on to worker processes through the environment
+QUIET_VAR = "ECG_QUIET"
+
+# prefix of the names of the Prometheus metrics
+PREFIX = "ecg"
+
+_stages = []
+_counters = {}
+
+
+"""
+This function turns quiet mode on or off.
+params:
+    quiet -> if True progress lines are not printed
+return: None
+"""
+
+def set_quiet(quiet=True):
+    os.environ[QUIET_VAR] = "1" if quiet else "0"
+
+
+"""
+return:
+    True if quiet mode is on
+"""
+
+def is_quiet():
+    return os.environ.get(QUIET_VAR, "0") == "1"
+
+
+"""
+This function prints a progress line which is overwritten by the next one,
+unless quiet mode is on.
+params:
+    *args -> values to print
+return: None
+"""
+
+def progress(*args):
+    if not is_quiet():
+        print(*args, end = '\r')
+
+
+"""
+This function prints a message, e.g. the banner marking the end of a step,
+unless quiet mode is on.
+params:
+    *args -> values to print
+return: None
+"""
+
+def message(*args):
+    if not is_quiet():
+        print(*args)
+
+
+"""
+This function gives the no. of bytes read and written by this process so
+far. They are taken from `/proc/self/io` and include reads served from the
+page cache. They are zero where it is not available.
+return:
+    no. of bytes read and written
+"""
+
+def io_bytes():
+    try:
+        with open("/proc/self/io") as file:
+            fields = dict(line.split(":") for line in file)
+    except OSError:
+        return 0, 0
+
+    return int(fields["rchar"]), int(fields["wchar"])
+
+
+"""
+return:
+    peak RSS of this process so far in bytes
+"""
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux and bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+"""
+This function measures the stage run inside the `with` block and keeps
+the measurement.
+params:
+    name -> name of the stage
+    patient -> id of the patient the stage is run for, if any
+    window -> time window of the record the stage is run for, if any
+"""
+
+@contextmanager
+def stage(name, patient=None, window=None):
+    with batch_stage(name, [(patient, window)]):
+        yield
+
+
+"""
+This function measures a stage run inside the `with` block for several
+patients at once, e.g. signals of the same length denoised together. Each
+of them is given an equal share of the times and of the bytes read and
+written, and is labelled with the no. of patients of the batch.
+params:
+    name -> name of the stage
+    members -> list of (id of the patient, time window or None) the stage
+               is run for
+"""
+
+@contextmanager
+def batch_stage(name, members):
+    read, written = io_bytes()
+    cpu = time.process_time()
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        end_read, end_written = io_bytes()
+        share = 1.0 / len(members)
+
+        for patient, window in members:
+            _stages.append({
+                "stage": name,
+                "patient": patient,
+                "window": window,
+                "batch": len(members) if len(members) > 1 else None,
+                "wall_seconds": wall * share,
+                "cpu_seconds": cpu * share,
+                "peak_rss_bytes": peak_rss(),
+                "read_bytes": int((end_read - read) * share),
+                "written_bytes": int((end_written - written) * share),
+                "pid": os.getpid(),
+            })
+
+
+"""
+This function increases a counter.
+params:
+    name -> name of the counter
+    value -> amount to add
+    patient -> id of the patient the counter belongs to, if any
+    window -> time window of the record the counter belongs to, if any
+return: None
+"""
+
+def count(name, value=1, patient=None, window=None):
+    key = (name, patient, window)
+    _counters[key] = _counters.get(key, 0) + int(value)
+
+
+"""
+This function takes the measurements of this process, so that a worker
+process can return them to the main process.
+return:
+    measurements of the stages and counters, which are removed from this
+    process
+"""
+
+def collect():
+    stages = list(_stages)
+    counters = [{"counter": name, "patient": patient, "window": window, "value": value}
+                for (name, patient, window), value in _counters.items()]
+
+    _stages.clear()
+    _counters.clear()
+
+    return {"stages": stages, "counters": counters}
+
+
+"""
+This function adds measurements taken by `collect` in another process.
+params:
+    collected -> measurements given by `collect`
+return: None
+"""
+
+def merge(collected):
+    _stages.extend(collected["stages"])
+    for item in collected["counters"]:
+        count(item["counter"], item["value"], item["patient"], item["window"])
+
+
+"""
+This function removes all the measurements.
+return: None
+"""
+
+def reset():
+    _stages.clear()
+    _counters.clear()
+
+
+"""
+This function writes the measurements as json lines.
+params:
+    path -> file to which the measurements are written
+return: None
+"""
+
+def write_json_lines(path):
+    with open(path, "w") as file:
+        for item in _stages:
+            file.write(json.dumps(item) + "\n")
+        for (name, patient, window), value in _counters.items():
+            file.write(json.dumps({"counter": name, "patient": patient,
+                                   "window": window, "value": value}) + "\n")
+
+
+"""
+This function gives the labels of a Prometheus sample.
+params:
+    **labels -> values of the labels, labels which are None are left out
+return:
+    labels in the Prometheus text format
+"""
+
+def prometheus_labels(**labels):
+    labels = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+              for name, value in labels.items() if value is not None]
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+"""
+This function writes the measurements in the Prometheus text format, e.g.
+for the textfile collector of the node exporter.
+params:
+    path -> file to which the measurements are written
+return: None
+"""
+
+def write_prometheus(path):
+    gauges = [
+        ("stage_wall_seconds", "wall_seconds", "Wall time of a pipeline stage."),
+        ("stage_cpu_seconds", "cpu_seconds", "Cpu time of a pipeline stage."),
+        ("stage_peak_rss_bytes", "peak_rss_bytes",
+         "Peak RSS of the process at the end of a pipeline stage."),
+        ("stage_read_bytes", "read_bytes", "Bytes read during a pipeline stage."),
+        ("stage_written_bytes", "written_bytes", "Bytes written during a pipeline stage."),
+    ]
+
+    lines = []
+
+    for metric, field, description in gauges:
+        lines.append("# HELP %s_%s %s" % (PREFIX, metric, description))
+        lines.append("# TYPE %s_%s gauge" % (PREFIX, metric))
+        for item in _stages:
+            lines.append("%s_%s%s %r" % (PREFIX, metric,
+                         prometheus_labels(stage=item["stage"], patient=item["patient"],
+                                           window=item["window"], batch=item["batch"]),
+                         item[field]))
+
+    for name in sorted(set(name for name, _, _ in _counters)):
+        lines.append("# TYPE %s_%s_total counter" % (PREFIX, name))
+        for (counter, patient, window), value in _counters.items():
+            if counter == name:
+                lines.append("%s_%s_total%s %d" % (PREFIX, name,
+                             prometheus_labels(patient=patient, window=window), value))
+
+    with open(path, "w") as file:
+        file.write("\n".join(lines) + "\n")
@@ -2,12 +2,24 @@
 This script is used to normalise all the segents to a same size.
 The segments initially are of different sizes, however, that can not
 be fed to the CNN. Thus, we need to normalise the size of segments.
+By default they are trimmed to the smallest segment, which is only known
+once every patient is preprocessed. With a target length given, each
+segment is fitted to it as soon as it is produced and written to the
+dataset patient by patient, so new patients can also be appended to an
+existing dataset.
 """
 
+import argparse
 import sys
 
+import numpy as np
 import pandas as pd
 
+import dataset
+import load_data
+import metrics
+import paths as const
+import pipeline
 import preprocess
 
 
@@ -25,7 +37,7 @@ def find_size(data):
 
     for patient in data:
         for segment in data[patient]:
-            min_size = min(segment.size, min_size)
+            min_size = min(len(segment), min_size)
 
     return min_size        
             
@@ -34,67 +46,309 @@ def find_size(data):
 This function is used to trim all the segments to the size of minimum segment.
 The segment is trimmed equally from both start and end to reduce biases.
 params:
-    segment -> segment we want to trim
+    segment -> segment we want to trim, segments of several leads have
+               one lead per column
     size -> size to which this segment has to be trimmed
 return:
     trimmed segment
 """
 
 def normalise(segment, size):
-    if segment.size > size:
-        start = ((segment.size) - size) // 2
+    if len(segment) > size:
+        start = (len(segment) - size) // 2
         return segment[start : start + size]
     return segment
 
 
 """
-This function is used to create a dataframe from the preprocessed data
-which will be fed to the CNN.
+This function fits a segment to a target length.
+params:
+    segment -> segment to fit, segments of several leads have one lead per
+               column
+    size -> target length
+    mode -> `crop` to trim the segment equally from both ends like
+            `normalise`, padding it equally with zeros at both ends when
+            it is shorter, or `resample` to stretch it to the target length
+            with linear interpolation
+return:
+    segment of `size` samples
+"""
+
+def fit_length(segment, size, mode="crop"):
+    segment = np.asarray(segment)
+    n = len(segment)
+
+    if mode == "resample":
+        if n == size:
+            return segment
+        x = np.linspace(0, n - 1, size)
+        xp = np.arange(n)
+        if segment.ndim == 1:
+            return np.interp(x, xp, segment)
+        return np.stack([np.interp(x, xp, lead) for lead in segment.T], axis=1)
+
+    if mode != "crop":
+        raise ValueError("Unknown mode %r, expected `crop` or `resample`." % mode)
+
+    if n >= size:
+        return normalise(segment, size)
+
+    before = (size - n) // 2
+    pad = [(before, size - n - before)] + [(0, 0)] * (segment.ndim - 1)
+    return np.pad(segment, pad)
+
+
+"""
+This function is used to build the dataset from the preprocessed data.
+The matrix of segments is allocated once and filled patient by patient.
 params:
     data -> preprocessed data
     normalise_size -> size of the smallest segment
 return:
-    DataFrame that can be fed to the CNN model
+    float32 matrix with one segment per row and the id of the patient of
+    each row. Segments of several leads have one lead per column, making
+    the matrix 3-D.
 """
 
-def create_df(data, normalised_size):
-    df = pd.DataFrame(columns = [i for i in range(normalised_size + 1)])
+def build_dataset(data, normalised_size):
+    rows = sum(len(data[patient]) for patient in data)
+
+    # no. of leads, the same for every segment
+    leads = ()
+    for patient in data:
+        if len(data[patient]) > 0:
+            leads = np.shape(data[patient][0])[1:]
+            break
+
+    segments = np.empty((rows, normalised_size) + leads, dtype=np.float32)
+    labels = np.empty(rows, dtype=object)
 
     ptr = 0
     idx = 1
     for patient in data:
-        print("Creating DataFrame for patient", idx, end = '\r')
+        metrics.progress("Creating dataset for patient", idx)
+
+        n = len(data[patient])
+        patient_segments = data[patient]
 
-        for ind in range(len(data[patient])):
-            data[patient][ind] = normalise(data[patient][ind], normalised_size)
-            df.loc[ptr] = data[patient][ind].tolist() + [patient]
-            ptr += 1
+        if isinstance(patient_segments, np.ndarray) \
+           and patient_segments.shape[1:2] == (normalised_size,):
+            segments[ptr : ptr + n] = patient_segments
+        else:
+            for ind in range(n):
+                segments[ptr + ind] = normalise(patient_segments[ind], normalised_size)
 
-            done = ((ind + 1) / len(data[patient])) * 100.0
-            print("Creating DataFrame for patient", idx, "%6.2f %% done" %(done), end = '\r')
-        
+        labels[ptr : ptr + n] = patient
+        ptr += n
         idx += 1
 
+    return segments, labels
+
+
+"""
+This function is used to create a dataframe from the preprocessed data
+which will be fed to the CNN.
+params:
+    data -> preprocessed data
+    normalise_size -> size of the smallest segment
+return:
+    DataFrame that can be fed to the CNN model. Segments of several leads
+    are flattened, the samples of each sample position being consecutive.
+"""
+
+def create_df(data, normalised_size):
+    segments, labels = build_dataset(data, normalised_size)
+    segments = segments.reshape(len(segments), -1)
+
+    df = pd.DataFrame(segments)
+    df[segments.shape[1]] = labels
+
     return df     
 
 
+"""
+This function writes the dataset patient by patient as they are
+preprocessed, fitting every segment to a target length.
+params:
+    path -> folder of the dataset
+    length -> target length of the segments
+    fit -> `crop` or `resample`, see `fit_length`
+    append -> if True only the patients missing from the dataset in `path`
+              are preprocessed and appended to it
+    leads -> no. of leads used
+    **kwargs -> other parameters of `preprocess.iter_preprocess`
+return:
+    no. of patients written
+"""
+
+def stream_dataset(path, length, fit="crop", append=False, leads=1, **kwargs):
+    fmt = kwargs.get("fmt", "csv")
+    const.find_paths(fmt=fmt)
+    ids = load_data.record_ids(fmt)
+
+    with dataset.DatasetWriter(path, length, leads if leads > 1 else None,
+                               append) as writer:
+        ids = [record_id for record_id in ids if record_id not in writer.patients]
+
+        written = 0
+        for record_id, segments in preprocess.iter_preprocess(ids, leads=leads, **kwargs):
+            with metrics.stage("write_dataset", record_id):
+                if isinstance(segments, np.ndarray) and segments.shape[1:2] == (length,):
+                    fitted = segments
+                else:
+                    fitted = np.empty((len(segments),) + writer.shape, dtype=np.float32)
+                    for ind, segment in enumerate(segments):
+                        fitted[ind] = fit_length(segment, length, fit)
+                writer.write(fitted, record_id)
+            written += 1
+
+    return written
+
+
 """
 This is the driver function that collects the preprocessed data,
-finds its normalised size and then returns the created dataframe in
-the form of a file.
+finds its normalised size and then writes the dataset to a file.
+params:
+    workers -> no. of worker processes used for preprocessing
+    fmt -> format of the data to load (`csv`, `store` or `raw`)
+    cache_dir -> directory of the stage cache, no cache is used if None
+    cache_size -> max size of the stage cache in bytes
+    width -> if given, segments are cut to this many samples directly
+             instead of being trimmed to the smallest segment
+    output -> `binary` to write the binary dataset in `../normalised_data`
+              or `csv` to write `../normalised_data.csv`
+    metrics_path -> if given, the measurements of the stages are written to
+                    this file as json lines
+    prometheus_path -> if given, the measurements of the stages are written
+                       to this file in the Prometheus text format
+    leads -> no. of leads used, segments have one channel per lead if more
+             than one
+    config -> pipeline configuration, the default one if None
+    length -> if given, every segment is fitted to this many samples and
+              written to the binary dataset as soon as its patient is
+              preprocessed
+    fit -> `crop` or `resample`, how segments are fitted to `length`, see
+           `fit_length`
+    append -> if True (with `length`) only the patients missing from the
+              dataset are preprocessed and appended to it, the rows already
+              in it are not modified
 """
 
-def get_normalised_data():
-    data = preprocess.preprocess()
+def get_normalised_data(workers=None, fmt="csv", cache_dir=None, cache_size=2 * 1024**3,
+                        width=None, output="binary", metrics_path=None,
+                        prometheus_path=None, leads=1, config=None, length=None,
+                        fit="crop", append=False):
+    if length is not None:
+        if output == "csv":
+            raise ValueError("Segments fitted to a length are only written to "
+                             "the binary dataset.")
+        written = stream_dataset('../normalised_data', length, fit, append, leads,
+                                 workers=workers, fmt=fmt, cache_dir=cache_dir,
+                                 cache_size=cache_size, width=width, config=config)
+        metrics.message("")
+        metrics.message("Patients written:", written)
+        metrics.message("========================= Normalization Completed =========================")
+        write_metrics(metrics_path, prometheus_path)
+        return
+
+    if append:
+        raise ValueError("Patients can only be appended with a target length.")
 
-    print("========================= Preprocessing Completed =========================")
+    data = preprocess.preprocess(workers=workers, fmt=fmt,
+                                 cache_dir=cache_dir, cache_size=cache_size,
+                                 width=width, leads=leads, config=config)
+
+    metrics.message("========================= Preprocessing Completed =========================")
 
     normalised_size = find_size(data)
 
-    df = create_df(data, normalised_size)
-    df.to_csv('../normalised_data.csv', encoding = 'utf-8', index = False)
+    if output == "csv":
+        with metrics.stage("create_df"):
+            df = create_df(data, normalised_size)
+        with metrics.stage("write_dataset"):
+            df.to_csv('../normalised_data.csv', encoding = 'utf-8', index = False)
+    else:
+        with metrics.stage("build_dataset"):
+            segments, labels = build_dataset(data, normalised_size)
+        with metrics.stage("write_dataset"):
+            dataset.write_dataset('../normalised_data', segments, labels)
+
+    metrics.message("========================= Normalization Completed =========================")
 
-    print("========================= Normalization Completed =========================")
+    write_metrics(metrics_path, prometheus_path)
+
+
+"""
+This function writes the measurements of the stages.
+params:
+    metrics_path -> json lines file, nothing is written if None
+    prometheus_path -> file in the Prometheus text format, nothing is
+                       written if None
+return: None
+"""
+
+def write_metrics(metrics_path, prometheus_path):
+    if metrics_path is not None:
+        metrics.write_json_lines(metrics_path)
+    if prometheus_path is not None:
+        metrics.write_prometheus(prometheus_path)
 
 if __name__ == "__main__":
-    get_normalised_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create the normalised dataset.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="no. of worker processes (default: no. of cpus)")
+    parser.add_argument("--format", choices=["csv", "store", "raw"], default="csv",
+                        help="read the csv files, the record store or the raw "
+                             "wfdb records")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory to cache the outputs of denoising, "
+                             "filtering and peak detection")
+    parser.add_argument("--cache-size", type=float, default=2.0,
+                        help="max size of the cache in GB")
+    parser.add_argument("--width", type=int, default=None,
+                        help="no. of samples in each segment (default: size "
+                             "of the smallest segment)")
+    parser.add_argument("--output", choices=["binary", "csv"], default="binary",
+                        help="write a binary dataset or a csv file")
+    parser.add_argument("--metrics", default=None,
+                        help="json lines file to which the measurements of "
+                             "the stages are written")
+    parser.add_argument("--prometheus", default=None,
+                        help="file to which the measurements of the stages "
+                             "are written in the Prometheus text format")
+    parser.add_argument("--quiet", action="store_true",
+                        help="do not print the progress of every patient")
+    parser.add_argument("--leads", type=int, default=1,
+                        help="no. of leads used as channels of the segments")
+    parser.add_argument("--config", default=None,
+                        help="json file with the parameters of the "
+                             "preprocessing stages")
+    parser.add_argument("--window", type=pipeline.parse_window, action="append",
+                        default=None,
+                        help="time window start:end in seconds of each record "
+                             "to process, may be repeated (default: the whole "
+                             "record). It is relative to the converted part "
+                             "for the csv and store formats")
+    parser.add_argument("--length", type=int, default=None,
+                        help="fit every segment to this many samples and write "
+                             "the dataset patient by patient")
+    parser.add_argument("--fit", choices=["crop", "resample"], default="crop",
+                        help="centred crop/pad or resampling to --length")
+    parser.add_argument("--append", action="store_true",
+                        help="append the patients missing from the dataset "
+                             "(requires --length)")
+    args = parser.parse_args()
+
+    metrics.set_quiet(args.quiet)
+
+    config = None
+    if args.config is not None:
+        config = pipeline.PipelineConfig.load(args.config)
+    if args.window:
+        config = config or pipeline.PipelineConfig()
+        config.windows = tuple(args.window)
+
+    get_normalised_data(args.workers, args.format,
+                        args.cache_dir, int(args.cache_size * 1024**3),
+                        args.width, args.output, args.metrics, args.prometheus,
+                        args.leads, config, args.length, args.fit, args.append)
\ No newline at end of file
@@ -1,58 +1,226 @@
 """
 This script is used to dynamically allocate paths to the Database.
+The Database folder is resolved in the following order:
+    1. `ECG_DATABASE` environment variable
+    2. `database` option of the `[paths]` section of `database.cfg` in the
+       root of the repository
+    3. paths cached in `.database_paths.json` by a previous search
+    4. a search of limited depth starting from the parent of the repository
+       which stops at the first match
+The result is remembered for the rest of the process. The Database holds
+a folder for each format of the records (`raw_data`, `csv_data` and
+`store_data`), and only the folder of the format which is used has to
+exist.
 """
 
+import configparser
+import json
 import os
-import platform
+from collections import deque
+from pathlib import Path
 
+import metrics
 
-CSV_PATH = ""
-RAW_PATH = ""
 
+CSV_PATH = None
+RAW_PATH = None
+STORE_PATH = None
 
-def find_paths():
-    print("")
-    print("Allocating paths", end = '\r')
+ENV_VAR = "ECG_DATABASE"
 
-    # directory where file recides
-    pwd = os.path.dirname(os.path.abspath(__file__))
-    
-    # directory where we want to search for Database
-    wd = os.path.dirname(os.path.dirname(pwd))
-    target_name = "Database"
-    target_dir = ""
+# root of the repository
+REPO_DIR = Path(__file__).resolve().parent.parent
 
+CONFIG_FILE = REPO_DIR / "database.cfg"
+MANIFEST_FILE = REPO_DIR / ".database_paths.json"
+
+# max depth of the search for the Database folder
+SEARCH_DEPTH = 4
+
+# folder of the records of each format
+DATA_DIRS = {"raw": "raw_data", "csv": "csv_data", "store": "store_data"}
+
+_resolved = False
+
+
+"""
+This function searches for a folder breadth first, so that the match
+closest to `root` is found and the search stops as soon as it is found.
+params:
+    root -> folder where the search starts
+    name -> name of the folder to find (case insensitive)
+    depth -> max depth up to which the search is done
+return:
+    path of the folder or None if it is not found
+"""
+
+def search_dir(root, name, depth):
+    queue = deque([(Path(root), 0)])
+
+    while queue:
+        folder, level = queue.popleft()
+        try:
+            entries = sorted(os.scandir(folder), key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+            except OSError:
+                continue
+            if entry.name.lower() == name.lower():
+                return Path(entry.path)
+            subdirs.append(Path(entry.path))
+
+        if level + 1 < depth:
+            queue.extend((subdir, level + 1) for subdir in subdirs)
+
+    return None
+
+
+"""
+This function reads the Database folder from the config file.
+return:
+    path of the Database or None if it is not configured
+"""
+
+def from_config():
+    if not CONFIG_FILE.exists():
+        return None
+
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+
+    database = config.get("paths", "database", fallback=None)
+    if not database:
+        return None
+
+    # relative paths are taken relative to the repository
+    return (REPO_DIR / Path(database).expanduser()).resolve()
+
+
+"""
+This function reads the paths cached by a previous search.
+return:
+    dictionary of the folder of each format or None if the cache is
+    missing or stale
+"""
+
+def from_manifest():
+    try:
+        with open(MANIFEST_FILE) as file:
+            manifest = json.load(file)
+        dirs = {fmt: Path(manifest[name]) for fmt, name in DATA_DIRS.items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    if not any(path.is_dir() for path in dirs.values()):
+        return None
+
+    return dirs
+
+
+"""
+This function finds the folders of the formats inside the Database. Folders
+which do not exist are placed next to the ones found, where they are
+created when records are converted to their format.
+params:
+    target_dir -> path of the Database
+return:
+    dictionary of the folder of each format
+"""
+
+def find_data_dirs(target_dir):
+    dirs = {fmt: search_dir(target_dir, name, SEARCH_DEPTH)
+            for fmt, name in DATA_DIRS.items()}
+
+    found = [path for path in dirs.values() if path is not None]
+    if not found:
+        raise ValueError("No raw, csv or store data found in the Database.")
+
+    for fmt, name in DATA_DIRS.items():
+        if dirs[fmt] is None:
+            dirs[fmt] = found[0].parent / name
+
+    return dirs
+
+
+"""
+This function checks that the folder of a format exists.
+params:
+    fmt -> `raw`, `csv` or `store`
+return: None
+"""
+
+def require(fmt):
+    path = {"raw": RAW_PATH, "csv": CSV_PATH, "store": STORE_PATH}[fmt]
+    if not path.is_dir():
+        raise ValueError("%s Database not found." % fmt.upper())
+
+
+"""
+This function allocates the paths to the Database. It is resolved only once
+per process unless `refresh` is True.
+params:
+    refresh -> if True the cached paths are ignored and resolved again
+    fmt -> if given (`raw`, `csv` or `store`), the folder of this format
+           must exist
+return: None
+"""
+
+def find_paths(refresh=False, fmt=None):
     global RAW_PATH
     global CSV_PATH
+    global STORE_PATH
+    global _resolved
 
-    for root, dirs, _ in os.walk(wd):
-        for dir_name in dirs:
-            if dir_name.lower() == target_name.lower():
-                target_dir = os.path.join(root, dir_name)
+    if _resolved and not refresh:
+        if fmt is not None:
+            require(fmt)
+        return
 
-    if target_dir == "":
-        raise ValueError("Database not found")
+    metrics.message("")
+    metrics.progress("Allocating paths")
 
-    for root, dirs, _ in os.walk(target_dir):
-        for dir_name in dirs:
-            if dir_name.lower() == "raw_data":
-                RAW_PATH = os.path.join(root, dir_name)
+    target_dir = os.environ.get(ENV_VAR)
+    if target_dir:
+        target_dir = Path(target_dir).expanduser().resolve()
+    else:
+        target_dir = from_config()
 
-    for root, dirs, _ in os.walk(target_dir):
-        for dir_name in dirs:
-            if dir_name.lower() == "csv_data":
-                CSV_PATH = os.path.join(root, dir_name)
+    if target_dir is not None:
+        if not target_dir.is_dir():
+            raise ValueError("Database not found")
+        dirs = find_data_dirs(target_dir)
 
-    if RAW_PATH == "":
-        raise ValueError("RAW Database not found.")
+    else:
+        dirs = None if refresh else from_manifest()
 
-    if CSV_PATH == "":
-        raise ValueError("CSV Database not found.")
+        if dirs is None:
+            # directory where we want to search for Database
+            wd = REPO_DIR.parent
+            target_dir = search_dir(wd, "Database", SEARCH_DEPTH)
 
-    if platform.system() == 'Windows':
-        RAW_PATH += "\\"
-        CSV_PATH += "\\"
-    else:
-        RAW_PATH += "/"
-        CSV_PATH += "/"
-        
+            if target_dir is None:
+                raise ValueError("Database not found")
+
+            dirs = find_data_dirs(target_dir)
+
+            try:
+                with open(MANIFEST_FILE, "w") as file:
+                    json.dump({name: str(dirs[fmt]) for fmt, name in DATA_DIRS.items()},
+                              file, indent=1)
+            except OSError:
+                pass
+
+    RAW_PATH = dirs["raw"]
+    CSV_PATH = dirs["csv"]
+    STORE_PATH = dirs["store"]
+
+    _resolved = True
+
+    if fmt is not None:
+        require(fmt)
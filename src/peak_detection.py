@@ -7,9 +7,13 @@ We have used the algorithm mentioned in the paper:
     BME-32.3 (1985), pp. 230–236.
 """
 
-from scipy.signal import butter, lfilter 
+from collections import deque
+
+from scipy.signal import sosfilt
 import numpy as np
 
+import pipeline
+
 
 """
 This function simulates the moving window integration according to
@@ -32,84 +36,275 @@ def cumulate(arr, window):
     return ret
 
 
+"""
+This function finds the candidate peaks i.e. the local maxima of the
+integrated signal.
+params:
+    detection -> it contains the array received from the `cumulate`
+                 function
+return:
+    indices of the local maxima
+"""
+
+def find_candidates(detection):
+    pre = detection[:-2]
+    cur = detection[1:-1]
+    nex = detection[2:]
+
+    return np.flatnonzero((pre < cur) & (nex < cur)) + 1
+
+
 """
 This function is the actual algorithm that adaptively detects the
-QRS complex.
+QRS complex. The adaptive thresholds are only applied to the candidate
+peaks found by `find_candidates`.
 params:
     detection -> it contains the array received from the `cumulate` 
                  function
     fs -> sample frequency of the signal
+    plan -> pipeline plan, compiled for `fs` if None
 return:
     indices of peaks
 """
 
-def pan_peak_detect(detection, fs):
-    min_distance = int(0.25*fs)
+def pan_peak_detect(detection, fs, plan=None):
+    if plan is None:
+        plan = pipeline.get_plan(fs)
+
+    detection = np.asarray(detection)
+    peaks = find_candidates(detection)
+
+    thresholds = _AdaptiveThreshold(plan)
+    return thresholds.update(peaks, detection[peaks])
+
+
+"""
+This class holds the adaptive thresholds of `pan_peak_detect` so that the
+candidate peaks (local maxima of the integrated signal) can be fed to it in
+batches. The searchback works on slices of the candidate arrays. Only the
+last 9 signal peaks and the candidates after the last detected peak are
+kept, which is all that the RR average and the searchback need.
+params:
+    plan -> pipeline plan of the sample frequency of the signal
+"""
+
+class _AdaptiveThreshold:
+    def __init__(self, plan):
+        self.fs = plan.fs
+        self.min_distance = plan.min_distance
+        self.min_rr = plan.min_rr
+
+        self.signal_peaks = deque([0], maxlen=9)
+
+        self.SPKI = 0.0
+        self.NPKI = 0.0
+
+        self.threshold_I1 = 0.0
+        self.threshold_I2 = 0.0
+
+        self.RR_missed = 0
+
+        # candidates seen after the last detected peak
+        self.section_peaks = np.zeros(0, dtype=np.int64)
+        self.section_values = np.zeros(0)
 
-    signal_peaks = [0]
-    noise_peaks = []
+    """
+    This function finds the missed peak between the last two detected
+    peaks from the candidates lying in between.
+    params:
+        peaks -> indices of the candidates between both peaks
+        values -> values of the integrated signal at `peaks`
+        threshold_I2 -> threshold used for the searchback
+    return:
+        index of the missed peak or None
+    """
 
-    SPKI = 0.0
-    NPKI = 0.0
+    def searchback(self, peaks, values, threshold_I2):
+        mask = (peaks - self.signal_peaks[-2] > self.min_distance) \
+               & (self.signal_peaks[-1] - peaks > self.min_distance) \
+               & (values > threshold_I2)
 
-    threshold_I1 = 0.0
-    threshold_I2 = 0.0
+        if not np.any(mask):
+            return None
 
-    RR_missed = 0
-    index = 0
-    indexes = []
+        return int(peaks[mask][np.argmax(values[mask])])
 
-    missed_peaks = []
-    peaks = []
+    """
+    This function applies the adaptive thresholds to the next candidates.
+    params:
+        peaks -> indices of candidates in increasing order
+        values -> values of the integrated signal at `peaks`
+    return:
+        list of confirmed signal peaks in increasing order
+    """
 
-    for i in range(len(detection)):
+    def update(self, peaks, values):
+        confirmed = []
+        start = 0
 
-        if i>0 and i<len(detection)-1:
-            if detection[i-1]<detection[i] \
-               and detection[i+1]<detection[i]:
-                peak = i
-                peaks.append(i)
+        signal_peaks = self.signal_peaks
+        min_rr = self.min_rr
+        SPKI = self.SPKI
+        NPKI = self.NPKI
+        threshold_I1 = self.threshold_I1
 
-                if detection[peak]>threshold_I1 \
-                   and (peak-signal_peaks[-1])>0.3*fs:
-                        
+        # plain python numbers are much faster to compare one at a time
+        for pos, (peak, value) in enumerate(zip(peaks.tolist(), values.tolist())):
+
+            if value > threshold_I1 and (peak - signal_peaks[-1]) > min_rr:
+
+                signal_peaks.append(peak)
+                SPKI = 0.125*value + 0.875*SPKI
+                missed_peak = None
+
+                if self.RR_missed != 0:
+                    if signal_peaks[-1] - signal_peaks[-2] > self.RR_missed:
+                        if len(self.section_peaks) > 0:
+                            section_peaks = np.concatenate((self.section_peaks, peaks[start:pos]))
+                            section_values = np.concatenate((self.section_values, values[start:pos]))
+                        else:
+                            section_peaks = peaks[start:pos]
+                            section_values = values[start:pos]
+
+                        missed_peak = self.searchback(section_peaks, section_values,
+                                                      0.5*threshold_I1)
+
+                if missed_peak is not None:
+                    signal_peaks.pop()
+                    signal_peaks.append(missed_peak)
                     signal_peaks.append(peak)
-                    indexes.append(index)
-                    SPKI = 0.125*detection[signal_peaks[-1]] \
-                           + 0.875*SPKI
-                    if RR_missed!=0:
-                        if signal_peaks[-1]-signal_peaks[-2]>RR_missed:
-                            missed_section_peaks = peaks[indexes[-2]+1:indexes[-1]]
-                            missed_section_peaks2 = []
-                            for missed_peak in missed_section_peaks:
-                                if missed_peak-signal_peaks[-2]>min_distance \
-                                   and signal_peaks[-1]-missed_peak>min_distance \
-                                   and detection[missed_peak]>threshold_I2:
-                                    missed_section_peaks2.append(missed_peak)
-
-                            if len(missed_section_peaks2)>0:           
-                                missed_peak = missed_section_peaks2[np.argmax(detection[missed_section_peaks2])]
-                                missed_peaks.append(missed_peak)
-                                signal_peaks.append(signal_peaks[-1])
-                                signal_peaks[-2] = missed_peak   
-
-                else:
-                    noise_peaks.append(peak)
-                    NPKI = 0.125*detection[noise_peaks[-1]] + 0.875*NPKI
-
-                threshold_I1 = NPKI + 0.25*(SPKI-NPKI)
-                threshold_I2 = 0.5*threshold_I1
-
-                if len(signal_peaks)>8:
-                    RR = np.diff(signal_peaks[-9:])
+                    confirmed.append(missed_peak)
+
+                confirmed.append(peak)
+
+                start = pos + 1
+                self.section_peaks = self.section_peaks[:0]
+                self.section_values = self.section_values[:0]
+
+                # RR average only changes when a signal peak is found
+                if len(signal_peaks) > 8:
+                    RR = np.diff(signal_peaks)
                     RR_ave = int(np.mean(RR))
-                    RR_missed = int(1.66*RR_ave)
+                    self.RR_missed = int(1.66*RR_ave)
 
-                index = index+1      
-    
-    signal_peaks.pop(0)
+            else:
+                NPKI = 0.125*value + 0.875*NPKI
+
+            threshold_I1 = NPKI + 0.25*(SPKI - NPKI)
+
+        self.SPKI = SPKI
+        self.NPKI = NPKI
+        self.threshold_I1 = threshold_I1
+        self.threshold_I2 = 0.5*threshold_I1
+
+        self.section_peaks = np.concatenate((self.section_peaks, peaks[start:]))
+        self.section_values = np.concatenate((self.section_values, values[start:]))
+
+        return confirmed
+
+
+"""
+This class detects the QRS complex on a signal which arrives in chunks of
+arbitrary size, e.g. a live feed or a recording too long to be loaded at
+once. The filter state, the tail of the moving window integration and the
+adaptive thresholds are carried from one chunk to the next, so that the
+peaks found do not depend on the size of the chunks. `detect_peaks` runs
+it over the whole signal. Memory used does not depend on the length of the
+signal.
+params:
+    fs -> sampling freq of the signal
+    plan -> pipeline plan holding the BPF and window lengths, compiled for
+            `fs` if None
+"""
+
+class StreamingPeakDetector:
+    def __init__(self, fs, plan=None):
+        if plan is None:
+            plan = pipeline.get_plan(fs)
+        self.fs = fs
+
+        self.sos = plan.bandpass
+        self.zi = np.zeros((len(self.sos), 2))
+
+        self.window = plan.window
+        self.blank = plan.blank
+
+        # last filtered sample, needed by the differentiation
+        self.last_filtered = None
+        # running sum of the squared signal and its last `window` values
+        self.total = 0.0
+        self.sum_tail = np.zeros(0)
+        # no. of integrated samples produced so far
+        self.count = 0
+        # last two integrated samples, needed to find local maxima
+        self.mwa_tail = np.zeros(0)
+
+        self.thresholds = _AdaptiveThreshold(plan)
 
-    return signal_peaks
+    """
+    This function simulates `cumulate` for the next part of the squared
+    signal.
+    params:
+        squared -> next part of the squared signal
+    return:
+        next part of the integrated signal
+    """
+
+    def integrate(self, squared):
+        window = self.window
+
+        sums = np.cumsum(np.concatenate(([self.total], squared)))[1:]
+        if len(sums) > 0:
+            self.total = sums[-1]
+
+        n_tail = len(self.sum_tail)
+        ext = np.concatenate((self.sum_tail, sums))
+        k = np.arange(self.count, self.count + len(sums))
+
+        mwa = sums.copy()
+        moving = k >= window
+        mwa[moving] = sums[moving] - ext[n_tail + np.flatnonzero(moving) - window]
+
+        starting = k < window - 1
+        mwa[starting] = mwa[starting] / (k[starting] + 1)
+        mwa[~starting] = mwa[~starting] / window
+
+        mwa[k < self.blank] = 0
+
+        self.sum_tail = ext[-window:]
+        self.count += len(sums)
+        return mwa
+
+    """
+    This function processes the next chunk of the signal.
+    params:
+        chunk -> next samples of the denoised ecg signal
+    return:
+        indices of the peaks confirmed by this chunk
+    """
+
+    def process(self, chunk):
+        chunk = np.asarray(chunk, dtype=float)
+        if len(chunk) == 0:
+            return []
+
+        filtered, self.zi = sosfilt(self.sos, chunk, zi=self.zi)
+
+        if self.last_filtered is None:
+            diff = np.diff(filtered)
+        else:
+            diff = np.diff(np.concatenate(([self.last_filtered], filtered)))
+        self.last_filtered = filtered[-1]
+
+        squared = diff*diff
+        start = self.count - len(self.mwa_tail)
+        mwa = np.concatenate((self.mwa_tail, self.integrate(squared)))
+        self.mwa_tail = mwa[-2:]
+
+        local_max = find_candidates(mwa)
+
+        peaks = local_max + start
+        return self.thresholds.update(peaks, mwa[local_max])
 
 
 """
@@ -120,28 +315,27 @@ done to achieve the desired output:
 -> Square the signal to amplify it.
 -> Apply moving window integration on the signal.
 -> Apply main algorithm to obtain indices of peaks
+The signal is processed in chunks by `StreamingPeakDetector`, so that none
+of the intermediate signals is held in memory for the whole recording.
 
 params:
-    signal -> denoised ecg signals whose peaks are to be detected
+    signal -> denoised ecg signals whose peaks are to be detected, may be
+              memory mapped
     fs -> sampling freq of the signal
+    plan -> pipeline plan, compiled for `fs` if None
 return:
     indices of peaks
 """
 
-def detect_peaks(signal, fs):
-    f_low = 5/fs
-    f_high = 15/fs
-
-    b, a = butter(1, [f_low*2, f_high*2], btype='bandpass')
-    filtered_ecg = lfilter(b, a, signal)
-    
-    diff = np.diff(filtered_ecg) 
-    squared = diff*diff
+def detect_peaks(signal, fs, plan=None):
+    if plan is None:
+        plan = pipeline.get_plan(fs)
 
-    N = int(0.12*fs)
-    mwa = cumulate(squared, N)
-    mwa[:int(0.2*fs)] = 0
+    detector = StreamingPeakDetector(fs, plan)
+    chunk_size = plan.chunk_size
 
-    mwa_peaks = pan_peak_detect(mwa, fs)
+    mwa_peaks = []
+    for start in range(0, len(signal), chunk_size):
+        mwa_peaks += detector.process(signal[start : start + chunk_size])
 
     return mwa_peaks
\ No newline at end of file
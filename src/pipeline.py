@@ -0,0 +1,217 @@
+"""
+This script holds the parameters of every stage of the preprocessing chain
+in one place. A `PipelineConfig` is compiled once per sampling frequency
+into a `PipelinePlan`, which holds the designed filters, the wavelet and
+the window lengths in samples, so that the stages do not recompute them
+for every record. Plans can be pickled and sent to worker processes.
+The parameters can be tuned from a json file, e.g.
+    {"cutoff": 0.7, "window": 0.15}
+The configuration also holds the time windows of each record which are
+processed, e.g. `"windows": [[0, 3600], [36000, 39600]]` for the first and
+the eleventh hour. Every window is processed on its own and the segments of
+all the windows of a patient are put together. Windows are measured from
+the start of the recording for raw records, and from the start of the
+converted part for csv files and the store.
+"""
+
+import json
+
+import pywt
+from scipy.signal import butter
+
+import filters
+
+
+# parameters of each stage, which the outputs of the stage depend on
+STAGE_PARAMS = {
+    "denoise": ("wavelet", "levels"),
+    "remove_baseline_wander": ("cutoff", "order"),
+    "detect_peaks": ("band", "band_order", "window", "blank", "min_distance", "min_rr"),
+    "segment": ("beats", "sample_window"),
+}
+
+
+"""
+This class holds the parameters of the preprocessing chain.
+params:
+    wavelet -> mother wavelet of the DWT used to denoise
+    levels -> levels of the DWT
+    cutoff -> cutoff frequency of the HPF removing baseline wander
+    order -> order of the HPF
+    band -> cutoff frequencies of the BPF of the peak detection
+    band_order -> order of the BPF
+    window -> duration of the integration window in seconds
+    blank -> duration at the start of the signal where no peak is detected
+    min_distance -> min distance of a missed peak from the detected peaks
+                    in seconds, used by the searchback
+    min_rr -> min duration between two peaks in seconds
+    beats -> no. of heartbeats in one segment
+    sample_window -> no. of samples before and after the peaks of a segment
+    chunk_size -> no. of samples filtered at a time
+    windows -> list of `(start, end)` time windows in seconds of each record
+               to process, `end` may be None for the end of the record. The
+               whole record is processed if None.
+"""
+
+class PipelineConfig:
+    def __init__(self, wavelet="db5", levels=10, cutoff=0.5, order=4,
+                 band=(5, 15), band_order=1, window=0.12, blank=0.2,
+                 min_distance=0.25, min_rr=0.3, beats=2, sample_window=128,
+                 chunk_size=filters.CHUNK_SIZE, windows=None):
+        self.wavelet = wavelet
+        self.levels = levels
+        self.cutoff = cutoff
+        self.order = order
+        self.band = tuple(band)
+        self.band_order = band_order
+        self.window = window
+        self.blank = blank
+        self.min_distance = min_distance
+        self.min_rr = min_rr
+        self.beats = beats
+        self.sample_window = sample_window
+        self.chunk_size = chunk_size
+        self.windows = None if windows is None else \
+            tuple((start, end) for start, end in windows)
+
+    """
+    This function gives the parameters of a stage, e.g. to be used in the
+    key of the stage cache.
+    params:
+        stage -> name of the stage, see `STAGE_PARAMS`
+    return:
+        dictionary of the parameters
+    """
+
+    def params(self, stage):
+        return {name: getattr(self, name) for name in STAGE_PARAMS[stage]}
+
+    """
+    return:
+        all the parameters as a tuple, which can be used as a key
+    """
+
+    def key(self):
+        return tuple(sorted(vars(self).items()))
+
+    """
+    This function compiles the configuration for a sampling frequency.
+    params:
+        fs -> sampling frequency, may be None for the stages which do not
+              depend on it (denoising and segmentation)
+    return:
+        the compiled plan
+    """
+
+    def compile(self, fs):
+        return PipelinePlan(self, fs)
+
+    """
+    This function loads a configuration from a json file. Parameters
+    missing from the file keep their default values.
+    params:
+        path -> json file containing the parameters
+    return:
+        the configuration
+    """
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls(**json.load(file))
+
+
+"""
+This class holds everything the stages need for a sampling frequency.
+params:
+    config -> the configuration
+    fs -> sampling frequency, may be None
+"""
+
+class PipelinePlan:
+    def __init__(self, config, fs):
+        self.config = config
+        self.fs = fs
+
+        self.wavelet = pywt.Wavelet(config.wavelet)
+        self.levels = config.levels
+        self.beats = config.beats
+        self.sample_window = config.sample_window
+        self.chunk_size = config.chunk_size
+
+        self.highpass = None
+        self.bandpass = None
+        self.window = None
+        self.blank = None
+        self.min_distance = None
+        self.min_rr = None
+
+        if fs is None:
+            return
+
+        nyq = 0.5 * fs
+        self.highpass = butter(config.order, config.cutoff / nyq, 'high', output='sos')
+
+        f_low = config.band[0]/fs
+        f_high = config.band[1]/fs
+        self.bandpass = butter(config.band_order, [f_low*2, f_high*2],
+                               btype='bandpass', output='sos')
+
+        self.window = int(config.window*fs)
+        self.blank = int(config.blank*fs)
+        self.min_distance = int(config.min_distance*fs)
+        self.min_rr = config.min_rr*fs
+
+
+# plans compiled by this process, see `get_plan`
+_plans = {}
+
+
+"""
+This function parses a time window given as `start:end` in seconds, where
+`end` may be left out for the end of the record, e.g. `3600:7200` or `0:`.
+params:
+    text -> the window
+return:
+    `(start, end)` of the window
+"""
+
+def parse_window(text):
+    start, sep, end = text.partition(":")
+    if not sep:
+        raise ValueError("Window %r must be given as start:end." % text)
+    return float(start or 0), float(end) if end else None
+
+
+"""
+This function gives the text of a time window, as parsed by `parse_window`.
+params:
+    window -> `(start, end)` of the window in seconds
+return:
+    the window as `start:end`
+"""
+
+def format_window(window):
+    start, end = window
+    return "%g:%s" % (start, "" if end is None else "%g" % end)
+
+
+"""
+This function gives the plan of a sampling frequency, compiling it the
+first time it is needed in this process.
+params:
+    fs -> sampling frequency, may be None
+    config -> the configuration, the default one if None
+return:
+    the compiled plan
+"""
+
+def get_plan(fs, config=None):
+    if config is None:
+        config = PipelineConfig()
+
+    key = (fs, config.key())
+    if key not in _plans:
+        _plans[key] = config.compile(fs)
+
+    return _plans[key]
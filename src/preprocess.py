@@ -3,84 +3,583 @@ This script is used to preprocess the data before sending it to the
 model. We remove the noise from signals, find peaks and then segment
 the data into smaller frames. Finally we return those frames in form
 of a dictionary.
+Patients can be processed in parallel by a pool of worker processes, each
+of which runs the whole chain for one patient at a time, or for several
+short ones whose signals are denoised together. The stages run for
+every patient are measured with `metrics` and the measurements taken by the
+workers are sent back along with the segments.
 """
 
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import groupby
+
+import numpy as np
+
+import paths as const
 import load_data
 import clean_signal
+import denoise
+import filters
+import metrics
 import peak_detection
+import pipeline
+import stage_cache
+
+
+"""
+This function finds the bounds of the frames of a signal according to the
+peaks detected.
+params:
+    peaks -> indices of detected peaks of the signal
+    N -> no. of samples in the signal
+    slide -> decide if we want the segments as moving window or not
+    plan -> pipeline plan holding the no. of heartbeats in one segment and
+            the no. of samples kept before and after the peaks, the
+            default one if None
+return:
+    arrays with the first and last index of each frame
+"""
+
+def frame_bounds(peaks, N, slide=True, plan=None):
+    if plan is None:
+        plan = pipeline.get_plan(None)
+
+    peaks = np.asarray(peaks, dtype=np.int64)
+    n = len(peaks)
+    one_seg = plan.beats # no. of heartbeats in one segment
+    sample_window = plan.sample_window # no. of samples before and after the peaks
+
+    if slide:
+        count = max(n - one_seg + 1, 0)
+        l = np.maximum(peaks[:count] - sample_window, 0)
+        r = np.minimum(peaks[one_seg - 1:one_seg - 1 + count] + sample_window, N - 1)
+    else:
+        # the last pair is only used if more peaks follow it
+        count = max((n - 1) // one_seg, 0)
+        l = peaks[0:count * one_seg:one_seg]
+        r = peaks[one_seg - 1:count * one_seg:one_seg]
+
+    return l, r
+
+
+"""
+This function finds the start of fixed width frames. Each frame is centred
+in the same way as `normalise.normalise` trims it, while frames shorter
+than `width` are extended equally on both sides within the signal.
+params:
+    peaks -> indices of detected peaks of the signal
+    N -> no. of samples in the signal
+    width -> no. of samples in each frame
+    slide -> decide if we want the segments as moving window or not
+    plan -> pipeline plan, see `frame_bounds`
+return:
+    array with the index of the first sample of each frame
+"""
+
+def segment_starts(peaks, N, width, slide=True, plan=None):
+    if width > N:
+        raise ValueError("Segment width is larger than the signal.")
+
+    l, r = frame_bounds(peaks, N, slide, plan)
+    starts = l + ((r - l + 1) - width) // 2
+
+    return np.clip(starts, 0, N - width)
 
 
 """
 This function is used to segment the signal for a particular person
 according to the peaks detected.
 params:
-    signal -> de-noised signal which we want to segment
+    signal -> de-noised signal which we want to segment, or 2-D array with
+              one lead per column, in which case every segment has all the
+              leads as channels
     peaks -> indices of detected peaks of tha same signals
     slide -> decide if we want the segments as moving window or not
+    width -> if given, the frames are centred windows of this many samples
+             and are returned as a single array of shape (no. of frames,
+             width) or (no. of frames, width, no. of leads)
+    plan -> pipeline plan, see `frame_bounds`
 return:
     segmented data for a particular signal
 """
 
-def segment(signal, peaks, slide=True):
-    n = len(peaks)
+def segment(signal, peaks, slide=True, width=None, plan=None):
     N = len(signal)
-    one_seg = 2 # no. of heartbeats in one segment
-    sample_window = 128 # no. of samples before and after the peaks
 
-    frames = []
+    if width is not None:
+        starts = segment_starts(peaks, N, width, slide, plan)
+        # view of every window of the signal, no data is copied until the
+        # windows of the frames are gathered into one array
+        windows = np.lib.stride_tricks.sliding_window_view(signal, width, axis=0)
+        if signal.ndim > 1:
+            # samples before leads, as the model expects its channels last
+            windows = np.moveaxis(windows, -1, 1)
+        return windows[starts]
 
-    if slide:
-        for i in range(0, n - one_seg + 1):
-            l = peaks[i]
-            r = peaks[i + one_seg - 1]
-            l = max(l - sample_window, 0)
-            r = min(r + sample_window, N - 1)
-            frames.append(signal[l: r + 1])
+    l, r = frame_bounds(peaks, N, slide, plan)
+    return [signal[start: end + 1] for start, end in zip(l, r)]
+
+
+"""
+This function gives the first lead of a signal, on which peaks are
+detected as the heartbeats are the same in every lead.
+params:
+    signal -> signal or 2-D array with one lead per column
+return:
+    signal of the first lead
+"""
+
+def first_lead(signal):
+    return signal if signal.ndim == 1 else signal[:, 0]
+
+
+# cache of the stage outputs of this process, see `get_cache`
+_cache = None
+
+
+"""
+This function gives the stage cache of this process, opening it the first
+time it is needed.
+params:
+    cache_dir -> directory of the cache
+    cache_size -> max size of the cache in bytes
+return:
+    the stage cache
+"""
+
+def get_cache(cache_dir, cache_size):
+    global _cache
+
+    if _cache is None or _cache.path != str(cache_dir):
+        _cache = stage_cache.StageCache(cache_dir, cache_size)
+
+    return _cache
+
+
+"""
+This function cleans the signal and detects its peaks, taking the outputs
+of denoising, baseline wander removal and peak detection from the stage
+cache when they are available.
+params:
+    signal -> noisy signal
+    fs -> sampling frequency of the signal
+    cache -> the stage cache
+    plan -> pipeline plan compiled for `fs`
+    patient -> id of the patient, used to label the measurements
+    window -> time window of the record, used to label the measurements
+return:
+    clean signal and indices of its peaks, which are detected on the first
+    lead
+"""
+
+def cached_stages(signal, fs, cache, plan, patient=None, window=None):
+    config = plan.config
+
+    params = config.params("denoise")
+    with metrics.stage("denoise", patient, window):
+        key, denoised = cache.run("denoise", signal, params,
+                                  lambda: denoise.denoise_signal(signal, plan))
+
+    params = dict(config.params("remove_baseline_wander"), fs=fs)
+    with metrics.stage("remove_baseline_wander", patient, window):
+        key, clean = cache.run("remove_baseline_wander", key, params,
+                               lambda: clean_signal.remove_baseline_wander(denoised, fs, plan))
+
+    params = dict(config.params("detect_peaks"), fs=fs)
+    with metrics.stage("detect_peaks", patient, window):
+        _, peaks = cache.run("detect_peaks", key, params,
+                             lambda: peak_detection.detect_peaks(first_lead(clean), fs, plan))
+
+    return clean, peaks.tolist()
+
+
+"""
+This function runs the whole preprocessing chain for a single patient i.e.
+loading, cleaning, peak detection and segmentation. It is run by the
+worker processes.
+params:
+    record_id -> id of the record
+    fmt -> format of the data to load (`csv`, `store` or `raw`)
+    cache_dir -> directory of the stage cache, no cache is used if None
+    cache_size -> max size of the stage cache in bytes
+    width -> if given, segments of this many samples are returned as a
+             single array
+    leads -> no. of leads processed, segments have one channel per lead if
+             more than one
+    config -> pipeline configuration, the default one if None. It is
+              compiled once per sampling frequency in each process. Only
+              the time windows of the configuration are loaded and each of
+              them is processed on its own.
+    records -> list of (sampling frequency, dataset) of each window of the
+               record if they are already loaded, e.g. by
+               `load_data.RecordPrefetcher`
+    index -> entries of the index of the Database containing this record,
+             used to find the frequency of csv files. It is loaded if not
+             given, which stats the whole Database.
+return:
+    id of the record, its segmented data and the no. of cache hits and
+    misses while processing it along with the measurements of its stages
+"""
+
+def preprocess_record(record_id, fmt="csv", cache_dir=None, cache_size=2 * 1024**3,
+                      width=None, leads=1, config=None, records=None, index=None):
+    results, stats = preprocess_records([record_id], fmt, cache_dir, cache_size, width,
+                                        leads, config, None if records is None else [records],
+                                        index)
+    return record_id, results[0][1], stats
+
+
+"""
+This function runs the whole preprocessing chain for several patients.
+Short signals of the same length, e.g. windows of a few seconds, are
+denoised together as the rows of one array, see `denoise.batches`. It is
+run by the worker processes.
+params:
+    record_ids -> ids of the records
+    fmt, cache_dir, cache_size, width, leads, config -> see
+        `preprocess_record`
+    records -> list with the `records` of each patient, see
+               `preprocess_record`
+    index -> entries of the index of the Database containing these
+             records, see `preprocess_record`
+    batch_samples -> max no. of samples denoised together. Signals are
+                     only denoised together without the stage cache, which
+                     keeps the outputs of every signal on their own.
+return:
+    list of (id, segmented data) of the records and the no. of cache hits
+    and misses while processing them along with the measurements of their
+    stages
+"""
+
+def preprocess_records(record_ids, fmt="csv", cache_dir=None, cache_size=2 * 1024**3,
+                       width=None, leads=1, config=None, records=None, index=None,
+                       batch_samples=2**17):
+    const.find_paths(fmt=fmt)
+
+    windows = None if config is None else config.windows
+    if records is None:
+        records = [[None] * len(windows or [None]) for _ in record_ids]
+
+    # signal of every window of every record
+    items = []
+    for record_id, loaded in zip(record_ids, records):
+        for window, record in zip(windows or [None], loaded):
+            label = None if window is None else pipeline.format_window(window)
+            with metrics.stage("load", record_id, label):
+                if record is None:
+                    record = load_data.load_record(record_id, fmt, index, window=window)
+                fs, dataset = record
+                # memory mapped records are read here, so that reading is measured
+                signal = np.array(load_data.lead_matrix(dataset, leads))
+
+            items.append((record_id, label, fs, pipeline.get_plan(fs, config), signal))
+
+    denoised = [None] * len(items)
+    if cache_dir is None:
+        denoised = denoise_items(items, width, batch_samples)
+
+    stats = {"hits": 0, "misses": 0}
+    parts = {record_id: [] for record_id in record_ids}
+
+    for (record_id, label, fs, plan, signal), clean in zip(items, denoised):
+        segments, hits, misses = preprocess_signal(signal, fs, plan, record_id,
+                                                   cache_dir, cache_size, width, label,
+                                                   clean)
+        parts[record_id].append(segments)
+        stats["hits"] += hits
+        stats["misses"] += misses
+
+    results = []
+    for record_id in record_ids:
+        if len(parts[record_id]) == 1:
+            segments = parts[record_id][0]
+        elif width is not None:
+            segments = np.concatenate(parts[record_id])
+        else:
+            segments = [frame for part in parts[record_id] for frame in part]
+        results.append((record_id, segments))
+
+    stats["metrics"] = metrics.collect()
+    return results, stats
+
+
+"""
+This function denoises the signals of several records, those of the same
+length and plan together. The denoising of a batch is measured once and
+split equally among its signals, see `metrics.batch_stage`.
+params:
+    items -> list of (id, window, sampling frequency, plan, signal) of the
+             signals
+    width -> see `preprocess_record`
+    batch_samples -> max no. of samples denoised together
+return:
+    list of denoised signals, None for signals too short to be processed
+"""
+
+def denoise_items(items, width=None, batch_samples=2**17):
+    # signals denoised together must share their plan
+    groups = {}
+    for idx, (_, _, _, plan, signal) in enumerate(items):
+        if not too_short(signal, plan, width):
+            groups.setdefault(id(plan), []).append(idx)
+
+    denoised = [None] * len(items)
+
+    for members in groups.values():
+        plan = items[members[0]][3]
+        for batch in denoise.batches([items[idx][4] for idx in members], batch_samples):
+            ids = [members[pos] for pos in batch]
+
+            with metrics.batch_stage("denoise", [items[idx][:2] for idx in ids]):
+                signals = denoise.denoise_batch([items[idx][4] for idx in ids], plan)
+
+            for idx, signal in zip(ids, signals):
+                denoised[idx] = signal
+
+    return denoised
+
+
+"""
+This function checks if a signal is too short to be filtered or to hold a
+segment.
+params:
+    signal -> noisy signal
+    plan -> pipeline plan compiled for its sampling frequency
+    width -> see `preprocess_record`
+return:
+    True if the signal gives no segments
+"""
+
+def too_short(signal, plan, width=None):
+    return len(signal) <= max(filters.pad_length(plan.highpass), width or 0)
+
+
+"""
+This function runs the cleaning, peak detection and segmentation on the
+signal of one record (or of one window of it). Signals too short to be
+filtered or to hold a segment give no segments.
+params:
+    signal -> noisy signal
+    fs -> sampling frequency of the signal
+    plan -> pipeline plan compiled for `fs`
+    record_id -> id of the record, used to label the measurements
+    cache_dir -> directory of the stage cache, no cache is used if None
+    cache_size -> max size of the stage cache in bytes
+    width -> see `preprocess_record`
+    window -> time window of the record as `start:end`, used to label the
+              measurements
+    denoised -> the signal once denoised, if it is already denoised e.g.
+                by `denoise_items`. It is not used with the stage cache.
+return:
+    segmented data and the no. of cache hits and misses
+"""
+
+def preprocess_signal(signal, fs, plan, record_id, cache_dir=None,
+                      cache_size=2 * 1024**3, width=None, window=None, denoised=None):
+    if too_short(signal, plan, width):
+        metrics.count("samples", len(signal), record_id, window)
+        if width is None:
+            return [], 0, 0
+        return np.zeros((0, width) + signal.shape[1:]), 0, 0
+
+    if cache_dir is None:
+        if denoised is None:
+            with metrics.stage("denoise", record_id, window):
+                denoised = denoise.denoise_signal(signal, plan)
+        signal = denoised
+        with metrics.stage("remove_baseline_wander", record_id, window):
+            signal = clean_signal.remove_baseline_wander(signal, fs, plan)
+        with metrics.stage("detect_peaks", record_id, window):
+            peaks = peak_detection.detect_peaks(first_lead(signal), fs, plan)
+        hits = misses = 0
     else:
-        for i in range(0, n, one_seg):
-            if i + one_seg >= n:
-                break
+        cache = get_cache(cache_dir, cache_size)
+        before = cache.stats()
+        signal, peaks = cached_stages(signal, fs, cache, plan, record_id, window)
+        hits = cache.stats()["hits"] - before["hits"]
+        misses = cache.stats()["misses"] - before["misses"]
+
+    with metrics.stage("segment", record_id, window):
+        segments = segment(signal, peaks, width=width, plan=plan)
 
-            l = peaks[i]
-            r = peaks[i + one_seg - 1]
-            frames.append(signal[l: r + 1])
+    metrics.count("samples", len(signal), record_id, window)
+    metrics.count("beats_detected", len(peaks), record_id, window)
+    metrics.count("segments", len(segments), record_id, window)
 
-    return frames
+    return segments, hits, misses
 
 
 """
-This is the driver function which preprocess the raw data.
+This function splits records into chunks processed together, so that
+short records are denoised together. Consecutive records are added to a
+chunk as long as it holds at most `limit` samples, while every chunk holds
+at least one record.
+params:
+    records -> iterable of records
+    sizes -> function giving the no. of samples of a record
+    limit -> max no. of samples in a chunk
 return:
-    preprocessed data in form of a dictionary where key is the id of
-    the signal and value is the segmented data.
+    iterator of lists of records
+"""
+
+def chunks(records, sizes, limit):
+    chunk = []
+    total = 0
+
+    for record in records:
+        size = sizes(record)
+        if chunk and total + size > limit:
+            yield chunk
+            chunk = []
+            total = 0
+        chunk.append(record)
+        total += size
+
+    if chunk:
+        yield chunk
+
+
+"""
+This function preprocesses the patients and gives the segments of each of
+them as soon as they are ready, so that they can be used without waiting
+for the other patients.
+params:
+    ids -> ids of the records to process, all of them if None
+    workers -> no. of worker processes, defaults to the no. of cpus. With
+               1 worker all the patients are processed in this process,
+               while the next ones are read by `load_data.RecordPrefetcher`.
+    max_in_flight -> max no. of tasks submitted to the workers at a time,
+                     defaults to twice the no. of workers. A task is one
+                     patient, or several short ones, see `batch_samples`.
+    fmt -> format of the data to load (`csv`, `store` or `raw`)
+    cache_dir -> directory of the stage cache, no cache is used if None
+    cache_size -> max size of the stage cache in bytes
+    width -> if given, the segments of each patient are a single array of
+             segments of this many samples
+    leads -> no. of leads processed, segments have one channel per lead if
+             more than one
+    config -> pipeline configuration, the default one if None
+    prefetch -> no. of records read ahead with 1 worker
+    memory_budget -> max size in bytes of the records read ahead with 1
+                     worker, None for no limit
+    batch_samples -> max no. of samples of the patients processed together
+                     without the stage cache, whose signals of the same
+                     length are denoised together. Records longer than this
+                     are processed on their own, as denoising them together
+                     is slower.
+return:
+    iterator of (id, segmented data) of the patients, in the order in which
+    they are finished
 """
 
-def preprocess():
-    data = load_data.load_data()
+def iter_preprocess(ids=None, workers=None, max_in_flight=None, fmt="csv",
+                    cache_dir=None, cache_size=2 * 1024**3, width=None, leads=1,
+                    config=None, prefetch=4, memory_budget=None, batch_samples=2**17):
+    const.find_paths(fmt=fmt)
+    if ids is None:
+        ids = load_data.record_ids(fmt)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    # signals are only denoised together without the stage cache
+    limit = batch_samples if cache_dir is None else 0
+    windows = None if config is None else config.windows
+
+    finished = 0
+    hits = 0
+    misses = 0
+
+    if workers == 1:
+        records = load_data.RecordPrefetcher(ids, fmt, prefetch, memory_budget,
+                                             windows=windows)
+        # the windows of a record are given one after another
+        patients = ((record_id, [(fs, dataset) for _, fs, dataset in items])
+                    for record_id, items in groupby(records, key=lambda item: item[0]))
+        sizes = lambda patient: leads * sum(len(dataset) for _, dataset in patient[1])
 
-    print("============================= Database loaded =============================")
+        for chunk in chunks(patients, sizes, limit):
+            metrics.progress("Preprocessing patient", finished + 1, "data")
+            results, stats = preprocess_records(
+                [record_id for record_id, _ in chunk], fmt, cache_dir, cache_size,
+                width, leads, config, [loaded for _, loaded in chunk], None,
+                batch_samples)
+            metrics.merge(stats["metrics"])
+            hits += stats["hits"]
+            misses += stats["misses"]
+            finished += len(chunk)
+            yield from results
 
-    freqs = data[0]
-    raw_signals = data[1]
-    ids = data[2]
+    else:
+        # the index is loaded once here, each worker is only sent the entries
+        # of its records
+        index = load_data.csv_index(fmt)
+
+        sizes = {record_id: 1 for record_id in ids}
+        if limit:
+            for record_id in ids:
+                fs, length = load_data.record_length(record_id, fmt, index)
+                bounds = [load_data.window_samples(window, fs, length)
+                          for window in windows or [None]]
+                sizes[record_id] = leads * sum(end - start for start, end in bounds)
+            # every worker is given a share of the records
+            limit = min(limit, -(-sum(sizes.values()) // workers))
 
-    signals = clean_signal.clean_signal(freqs, raw_signals)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
 
-    print("============================== Noises Removed =============================")
+            for chunk in chunks(ids, sizes.get, limit):
+                entries = None if index is None else \
+                    {record_id: index[record_id] for record_id in chunk}
+                pending.add(executor.submit(preprocess_records, chunk, fmt,
+                                            cache_dir, cache_size, width, leads, config,
+                                            None, entries, batch_samples))
 
-    preprocessed_data = {}
+                # wait for some patients to finish before submitting more
+                # so that only a bounded no. of signals are in memory
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results, stats = future.result()
+                        metrics.merge(stats["metrics"])
+                        hits += stats["hits"]
+                        misses += stats["misses"]
+                        finished += len(results)
+                        metrics.progress("Preprocessed", finished, "of", len(ids), "patients")
+                        yield from results
 
-    for idx in range(0, len(signals)):
-        signal = signals[idx]
-        freq = freqs[idx]
+            for future in pending:
+                results, stats = future.result()
+                metrics.merge(stats["metrics"])
+                hits += stats["hits"]
+                misses += stats["misses"]
+                yield from results
 
-        print("Detecting peaks in patient", idx + 1, "data", end = '\r')
+    if cache_dir is not None:
+        metrics.message("")
+        metrics.message("Stage cache:", hits, "hits,", misses, "misses")
 
-        peaks = peak_detection.detect_peaks(signal, freq)
 
-        segmented_data = segment(signal, peaks)
+"""
+This is the driver function which preprocess the raw data.
+params:
+    see `iter_preprocess`
+return:
+    preprocessed data in form of a dictionary where key is the id of
+    the signal and value is the segmented data. Keys are ordered by id.
+"""
 
-        preprocessed_data[ids[idx]] = segmented_data
+def preprocess(workers=None, max_in_flight=None, fmt="csv",
+               cache_dir=None, cache_size=2 * 1024**3, width=None, leads=1,
+               config=None, prefetch=4, memory_budget=None, batch_samples=2**17):
+    const.find_paths(fmt=fmt)
+    ids = load_data.record_ids(fmt)
 
-    return preprocessed_data
+    results = dict(iter_preprocess(ids, workers, max_in_flight, fmt, cache_dir,
+                                   cache_size, width, leads, config, prefetch,
+                                   memory_budget, batch_samples))
 
+    return {record_id: results[record_id] for record_id in ids}
@@ -5,9 +5,14 @@ First we import the directory and path to the raw data. Then the script reads
 names of all records. These records are then read using wfdb and are converted
 to csv format using `to_csv` function. For more information on how this
 function works, please look into function description.
+The records can also be converted to the binary record store using
+`to_store` function, which is much faster to write and load. The store
+keeps the integer samples of the ADC with the gain and baseline of each
+lead, which takes 4 times less space than physical units.
 """
 
 
+import argparse
 import os
 
 import wfdb as wf
@@ -15,6 +20,9 @@ import numpy as np
 import pandas as pd
 
 import paths as const
+import load_data
+import pipeline
+import record_store
 
 """
     Reads the records of a patient using wfdb - native Python 
@@ -24,55 +32,130 @@ import paths as const
     Finally this data is converted to csv format and stored under specified 
     file name.
     Note: The original data contains 25 hours long ECG recordings. However,
-          here we have used 2 hours of data only.
+          here we have used 2 hours of data only by default. Any other
+          window of the record can be converted, only its samples are
+          read. Records shorter than the window are converted up to their
+          end.
     
     params: file name of the concerned record
+            window -> `(start, end)` in seconds of the part to convert, `end`
+                      may be None for the end of the record
     return: None
 """
 
-def to_csv(file):
-    dataset = const.RAW_PATH + file
-    dataset_csv = const.CSV_PATH + file + ".csv"
+def to_csv(file, window=(0, 7200)):
+    dataset = str(const.RAW_PATH / file)
+    dataset_csv = const.CSV_PATH / (file + ".csv")
     
     # make the folder to store csv files if it does not already exist
     if not os.path.exists(const.CSV_PATH):
         os.mkdir(const.CSV_PATH)
-        
-    record = wf.rdrecord(dataset)
+
+    header = wf.rdheader(dataset)
+    freq = header.fs
+    sampfrom, sampto = load_data.window_samples(window, freq, header.sig_len)
+    if sampto <= sampfrom:
+        raise ValueError("Record %s has no samples in the window %s." % (file, window))
+
+    record = wf.rdrecord(dataset, sampfrom=sampfrom, sampto=sampto)
     readings = record.__dict__['p_signal']
     
     # `readings` contains two colums containing ecg signals corresponding to
     # lead 1 and lead 2 respectively.
 
-    freq = record.__dict__['fs']
-    samples = 7200*freq
+    samples = len(readings)
     
     data = np.zeros((samples,3))
     
-    for i in range(0, samples):
-        data[i][0] = (i/freq)
-        data[i][1] = readings[i][0]
-        data[i][2] = readings[i][1]
+    data[:, 0] = np.arange(sampfrom, sampfrom + samples) / freq
+    data[:, 1:] = readings[:, :2]
         
     pd.DataFrame(data).to_csv(dataset_csv, 
                               header=['timestamp', 'lead1', 'lead2'], 
                               index=False)
 
 
+"""
+    Reads the records of a patient using wfdb and stores them in the binary
+    record store. Unlike the csv format all the leads are kept along with
+    their names and units, while the time-stamps are not stored as they can
+    be computed from the frequency. By default the digital samples
+    (`d_signal`) are stored as 16 bit integers (32 bit if they do not fit)
+    with the gain and baseline of each lead, which are converted to
+    physical units when the record is loaded.
+    Note: Like `to_csv` only the first 2 hours of data are stored by
+          default.
+
+    params: file name of the concerned record
+            digital -> if False the physical samples are stored as float64
+            window -> `(start, end)` in seconds of the part to store, see
+                      `to_csv`
+    return: None
+"""
+
+def to_store(file, digital=True, window=(0, 7200)):
+    dataset = str(const.RAW_PATH / file)
+    dataset_store = const.STORE_PATH / (file + record_store.EXTENSION)
+
+    # make the folder to store records if it does not already exist
+    if not os.path.exists(const.STORE_PATH):
+        os.mkdir(const.STORE_PATH)
+
+    header = wf.rdheader(dataset)
+    freq = header.fs
+    sampfrom, sampto = load_data.window_samples(window, freq, header.sig_len)
+    if sampto <= sampfrom:
+        raise ValueError("Record %s has no samples in the window %s." % (file, window))
+
+    if not digital:
+        record = wf.rdrecord(dataset, sampfrom=sampfrom, sampto=sampto)
+        record_store.write_record(dataset_store, record.p_signal, freq,
+                                  record.sig_name, record.units, start=sampfrom)
+        return
+
+    record = wf.rdrecord(dataset, sampfrom=sampfrom, sampto=sampto, physical=False)
+    readings = record.d_signal
+    record_store.write_record(dataset_store, readings, freq,
+                              record.sig_name, record.units,
+                              dtype=record_store.digital_dtype(readings),
+                              gain=record.adc_gain, baseline=record.baseline,
+                              start=sampfrom)
+
+
 """
 Driver function used to convert raw data to csv format
+params:
+    fmt -> `csv` to convert to csv format or `store` to convert to the
+           binary record store
+    digital -> if False records of the store are kept in physical units
+    window -> `(start, end)` in seconds of the part of each record to
+              convert
 """
 
-def raw_to_csv():
-    const.find_paths() 
+def raw_to_csv(fmt="csv", digital=True, window=(0, 7200)):
+    const.find_paths(fmt="raw")
     # `files` contains names of all patients records
     files = [file[:-4] 
              for file in os.listdir(const.RAW_PATH) 
              if file.endswith('.dat')]
     
     for file in files:
-        to_csv(file)
+        if fmt == "store":
+            to_store(file, digital, window)
+        else:
+            to_csv(file, window)
     
 
 if __name__ == "__main__":
-    raw_to_csv()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Convert raw physionet data.")
+    parser.add_argument("--format", choices=["csv", "store"], default="csv")
+    parser.add_argument("--physical", action="store_true",
+                        help="store float64 physical samples instead of the "
+                             "digital samples of the ADC")
+    parser.add_argument("--window", type=pipeline.parse_window, default=(0, 7200),
+                        help="part of each record to convert as start:end in "
+                             "seconds, e.g. 3600:7200 or 0: for the whole "
+                             "record (default: 0:7200)")
+    args = parser.parse_args()
+
+    raw_to_csv(args.format, not args.physical, args.window)
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""
+This script is used to build an index of the metadata of all the records
+in the Database. The metadata (sampling frequency, no. of samples, names,
+units, gains and baselines of leads) is read from the `.hea` header files
+only, so that the raw signals do not have to be decoded just to know their
+frequency. The index is saved in the raw data folder and is rebuilt only
+for the records whose files have changed since it was last built. The
+index of a Database whose raw data folder cannot be written, e.g. a shared
+read-only one, is saved in `CACHE_DIR` instead, or only kept in memory if
+that cannot be written either.
+"""
+
+import hashlib
+import json
+import os
+
+import wfdb as wf
+
+import fileutil
+import paths as const
+
+
+INDEX_FILE = "record_index.json"
+
+# folder of the indexes of the Databases whose raw data folder is read-only
+CACHE_DIR = const.REPO_DIR / ".record_index"
+
+
+"""
+This function gives the file in `CACHE_DIR` in which the index of a
+Database is saved when its raw data folder cannot be written.
+params:
+    raw_path -> folder containing the raw data
+return:
+    path of the index file
+"""
+
+def cache_path(raw_path):
+    name = hashlib.sha1(os.path.abspath(raw_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, name + ".json")
+
+
+"""
+This function reads an index file.
+params:
+    index_path -> path of the index file
+return:
+    the index, None if the file is missing or cannot be read
+"""
+
+def read_index(index_path):
+    try:
+        with open(index_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+"""
+This function finds the fingerprint of the files of a record i.e. their
+size and time of last modification.
+params:
+    raw_path -> folder containing the raw data
+    files -> names of the files of the record
+return:
+    dictionary with the fingerprint of each file
+"""
+
+def fingerprint(raw_path, files):
+    res = {}
+    for file in files:
+        try:
+            stat = os.stat(os.path.join(raw_path, file))
+        except FileNotFoundError:
+            res[file] = None
+            continue
+        res[file] = [stat.st_size, stat.st_mtime_ns]
+
+    return res
+
+
+"""
+This function reads the metadata of a record from its header.
+params:
+    raw_path -> folder containing the raw data
+    name -> name of the record
+return:
+    dictionary containing the metadata of the record
+"""
+
+def read_entry(raw_path, name):
+    header = wf.rdheader(os.path.join(raw_path, name))
+
+    files = [name + ".hea"] + sorted(set(header.file_name or []))
+
+    return {
+        "fs": header.fs,
+        "sig_len": header.sig_len,
+        "sig_name": header.sig_name,
+        "units": header.units,
+        "adc_gain": header.adc_gain,
+        "baseline": header.baseline,
+        "files": fingerprint(raw_path, files),
+    }
+
+
+"""
+This function loads the index of the Database, building or updating it
+if some records have been added, removed or modified.
+params:
+    raw_path -> folder containing the raw data, defaults to the one found
+                by `paths.find_paths`
+    rebuild -> if True the index is built again from all the headers
+return:
+    dictionary mapping the name of each record to its metadata
+"""
+
+def load_index(raw_path=None, rebuild=False):
+    if raw_path is None:
+        raw_path = const.RAW_PATH
+
+    index_path = os.path.join(raw_path, INDEX_FILE)
+    fallback = cache_path(raw_path)
+
+    index = {}
+    if not rebuild:
+        # the copy in the cache exists only if the raw data folder could
+        # not be written, and is newer in that case
+        index = read_index(fallback) or read_index(index_path) or {}
+
+    names = sorted(file[:-4] for file in os.listdir(raw_path)
+                   if file.endswith(".hea"))
+
+    changed = set(index) != set(names)
+    updated = {}
+
+    for name in names:
+        entry = index.get(name)
+        if entry is None \
+           or fingerprint(raw_path, entry["files"]) != entry["files"]:
+            entry = read_entry(raw_path, name)
+            changed = True
+        updated[name] = entry
+
+    if changed and not write_index(index_path, updated):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+        except OSError:
+            pass
+        # the index is still returned if it cannot be saved anywhere
+        write_index(fallback, updated)
+
+    return updated
+
+
+"""
+This function writes the index through a temporary file of its own (see
+`fileutil.write_atomic`), so that several processes can update the index at the same time, the last
+one to finish replacing the index.
+params:
+    index_path -> path of the index file
+    index -> dictionary mapping the name of each record to its metadata
+return:
+    False if the index could not be written, e.g. in a read-only folder
+"""
+
+def write_index(index_path, index):
+    try:
+        fileutil.write_atomic(index_path,
+                              lambda file: json.dump(index, file, indent=1), "w")
+    except OSError:
+        return False
+
+    return True
@@ -0,0 +1,243 @@
+"""
+This script is used to store the ECG recordings in a binary format which
+is much faster to load than csv. Each record is kept in its own file which
+starts with a small header containing the metadata of the record (sampling
+frequency, names and units of leads, no. of samples and data type). The
+header is followed by the samples of each lead stored one after another,
+so that every lead is a contiguous column which can be memory mapped. The
+time-stamps are not stored as they can be computed from the sampling
+frequency and the first sample of the stored part in the recording.
+Samples can be stored either in physical units or as the integers given by
+the ADC (the `d_signal` of wfdb), along with the gain and baseline of each
+lead. Integer samples take 2 bytes instead of 8 and are only converted to
+float32 physical units when a lead is accessed, i.e. right before it is
+filtered.
+"""
+
+import copy
+import json
+import struct
+
+import numpy as np
+
+
+MAGIC = b"ECGSTORE"
+EXTENSION = ".ecg"
+
+# data starts at a multiple of this many bytes
+ALIGNMENT = 64
+
+
+"""
+This function writes a record to the store.
+params:
+    path -> file to which the record is written
+    signal -> array of shape (no. of samples, no. of leads)
+    fs -> sampling frequency of the signal
+    leads -> names of the leads
+    units -> units of the leads
+    dtype -> data type in which the samples are stored
+    gain -> ADC gain of each lead if the samples are digital, i.e.
+            physical = (digital - baseline) / gain. None for samples in
+            physical units.
+    baseline -> ADC baseline of each lead if the samples are digital
+    start -> index in the recording of the first sample stored
+return: None
+"""
+
+def write_record(path, signal, fs, leads, units, dtype=np.float64, gain=None,
+                 baseline=None, start=0):
+    signal = np.asarray(signal)
+    if signal.ndim == 1:
+        signal = signal[:, np.newaxis]
+
+    header = {
+        "fs": fs,
+        "leads": list(leads),
+        "units": list(units),
+        "length": int(signal.shape[0]),
+        "dtype": np.dtype(dtype).str,
+        "start": int(start),
+    }
+
+    if len(header["leads"]) != signal.shape[1]:
+        raise ValueError("Number of lead names does not match the signal.")
+
+    if gain is not None:
+        if not np.issubdtype(np.dtype(dtype), np.integer):
+            raise ValueError("Digital samples must be stored as integers.")
+        header["gain"] = [float(value) for value in gain]
+        header["baseline"] = [int(value) for value in
+                              (baseline if baseline is not None else [0] * len(gain))]
+        if len(header["gain"]) != signal.shape[1] \
+           or len(header["baseline"]) != signal.shape[1]:
+            raise ValueError("Number of gains or baselines does not match the signal.")
+
+    text = json.dumps(header).encode("utf-8")
+    offset = len(MAGIC) + 4 + len(text)
+    text += b" " * (-offset % ALIGNMENT)
+
+    # leads are written one after another i.e. in column major order
+    columns = np.asarray(signal.T, dtype=np.dtype(dtype))
+
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<I", len(text)))
+        file.write(text)
+        columns.tofile(file)
+
+
+"""
+This function reads the header of a record without reading its samples.
+params:
+    path -> file containing the record
+return:
+    dictionary containing the metadata of the record along with `offset`
+    of the samples in the file
+"""
+
+def read_header(path):
+    with open(path, "rb") as file:
+        magic = file.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("%s is not a record store file." %(path))
+
+        size, = struct.unpack("<I", file.read(4))
+        header = json.loads(file.read(size).decode("utf-8"))
+
+    header["offset"] = len(MAGIC) + 4 + size
+    return header
+
+
+"""
+This function gives the smallest integer type which can store digital
+samples.
+params:
+    signal -> array of digital samples
+return:
+    int16 or int32
+"""
+
+def digital_dtype(signal):
+    signal = np.asarray(signal)
+    info = np.iinfo(np.int16)
+    if signal.size == 0 or (signal.min() >= info.min and signal.max() <= info.max):
+        return np.dtype(np.int16)
+    return np.dtype(np.int32)
+
+
+"""
+This function converts digital samples to physical units.
+params:
+    samples -> digital samples of one lead, or array with one lead per
+               column
+    gain -> ADC gain of the lead (or of each lead)
+    baseline -> ADC baseline of the lead (or of each lead)
+return:
+    float32 samples in physical units
+"""
+
+def to_physical(samples, gain, baseline):
+    physical = np.asarray(samples, dtype=np.float32)
+    physical -= np.float32(baseline) if np.ndim(baseline) == 0 \
+                else np.asarray(baseline, dtype=np.float32)
+    physical /= np.float32(gain) if np.ndim(gain) == 0 \
+                else np.asarray(gain, dtype=np.float32)
+    return physical
+
+
+"""
+This class gives access to a record of the store. Leads can be accessed by
+their names or by their position as `lead1`, `lead2` and so on, while
+`time` (or `timestamp`) gives the time-stamps of the samples. This allows
+it to be used in place of the datasets loaded from csv files. Leads of
+digital records are given in physical units as float32, while `signal`
+holds the stored integers.
+params:
+    path -> file containing the record
+    mmap -> if True the samples are memory mapped instead of being read
+"""
+
+class StoredRecord:
+    def __init__(self, path, mmap=True):
+        header = read_header(path)
+
+        self.path = path
+        self.fs = header["fs"]
+        self.leads = header["leads"]
+        self.units = header["units"]
+        self.length = header["length"]
+        # index in the recording of the first sample, see `window`. Records
+        # stored before it was kept start at 0
+        self.start = header.get("start", 0)
+        self.gain = header.get("gain")
+        self.baseline = header.get("baseline")
+
+        shape = (len(self.leads), self.length)
+        dtype = np.dtype(header["dtype"])
+
+        if mmap:
+            self.signal = np.memmap(path, dtype=dtype, mode="r",
+                                    offset=header["offset"], shape=shape)
+        else:
+            with open(path, "rb") as file:
+                file.seek(header["offset"])
+                self.signal = np.fromfile(file, dtype=dtype,
+                                          count=shape[0]*shape[1]).reshape(shape)
+
+    def __len__(self):
+        return self.length
+
+    """
+    This function gives a part of the record. Only the samples of the part
+    are read when the record is memory mapped.
+    params:
+        sampfrom -> first sample of the part
+        sampto -> end sample of the part (excluded), the end of the record
+                  if None
+    return:
+        record holding the samples of the part
+    """
+
+    def window(self, sampfrom=0, sampto=None):
+        part = copy.copy(self)
+        part.signal = self.signal[:, sampfrom:sampto]
+        part.length = part.signal.shape[1]
+        part.start = self.start + min(sampfrom, self.length)
+        return part
+
+    """
+    return:
+        True if the samples are stored as digital integers
+    """
+
+    def is_digital(self):
+        return self.gain is not None
+
+    """
+    This function gives a lead in physical units.
+    params:
+        pos -> position of the lead
+    return:
+        samples of the lead, float32 for digital records
+    """
+
+    def lead(self, pos):
+        if self.is_digital():
+            return to_physical(self.signal[pos], self.gain[pos], self.baseline[pos])
+        return self.signal[pos]
+
+    def __getitem__(self, name):
+        if name in ("time", "timestamp"):
+            return np.arange(self.start, self.start + self.length) / self.fs
+
+        if name in self.leads:
+            return self.lead(self.leads.index(name))
+
+        if name.startswith("lead") and name[4:].isdigit():
+            pos = int(name[4:]) - 1
+            if 0 <= pos < len(self.leads):
+                return self.lead(pos)
+
+        raise KeyError(name)
+
@@ -0,0 +1,214 @@
+"""
+This script is used to cache the outputs of the costly stages of the
+pipeline (DWT denoising, baseline wander removal and peak detection) on
+disk. Every output is stored under a key which is the hash of the input
+record and the parameters of the stage and of all the stages before it.
+Thus changing a parameter of a stage only recomputes that stage and the
+ones after it.
+The size of the cache is capped, the least recently used entries being
+evicted first. Entries are written to a temporary file and then renamed,
+so that several processes can share the same cache directory. Each process
+keeps a running total of the size of the cache, which only counts the
+entries written by other processes when the directory is scanned again,
+i.e. when the total goes over the cap.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import fileutil
+
+
+EXTENSION = ".npy"
+
+# share of the max size to which the cache is brought back by an eviction,
+# so that the directory is not scanned again after every new entry
+LOW_WATER = 0.9
+
+
+"""
+This class gives access to a cache directory and counts its hits and
+misses.
+params:
+    path -> directory where the outputs are stored
+    max_bytes -> max size of the cache in bytes
+"""
+
+class StageCache:
+    def __init__(self, path, max_bytes=2 * 1024**3):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        _, self.size = self.scan()
+
+    """
+    This function finds the key of the output of a stage.
+    params:
+        stage -> name of the stage
+        source -> input array of the stage or key of the previous stage
+        params -> dictionary of parameters of the stage
+    return:
+        key of the output
+    """
+
+    def key(self, stage, source, params):
+        digest = hashlib.sha256()
+        digest.update(stage.encode("utf-8"))
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+
+        if isinstance(source, str):
+            digest.update(source.encode("utf-8"))
+        else:
+            source = np.ascontiguousarray(source)
+            digest.update(str(source.dtype).encode("utf-8"))
+            digest.update(str(source.shape).encode("utf-8"))
+            digest.update(source.data)
+
+        return digest.hexdigest()
+
+    """
+    This function gives the file in which the output of a key is stored.
+    """
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + EXTENSION)
+
+    """
+    This function reads the output stored under a key.
+    params:
+        key -> key of the output
+    return:
+        the stored array or None if it is not in the cache
+    """
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            value = np.load(path, allow_pickle=False)
+        except (FileNotFoundError, ValueError, EOFError):
+            # missing, evicted by another process or unreadable
+            self.misses += 1
+            return None
+
+        # the time of modification is used to find the least recently
+        # used entries
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return value
+
+    """
+    This function stores an output under a key.
+    params:
+        key -> key of the output
+        value -> array to be stored
+    return: None
+    """
+
+    def put(self, key, value):
+        path = self.entry_path(key)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+
+        try:
+            # an entry written by another process is replaced
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+
+        def write(file):
+            np.save(file, np.asarray(value), allow_pickle=False)
+            return file.tell()
+
+        size = fileutil.write_atomic(path, write)
+
+        self.size += size - replaced
+        if self.size > self.max_bytes:
+            self.evict()
+
+    """
+    This function returns the output of a stage from the cache, running
+    the stage and storing its output if it is not there.
+    params:
+        stage -> name of the stage
+        source -> input array of the stage or key of the previous stage
+        params -> dictionary of parameters of the stage
+        func -> function which computes the output if it is not cached
+    return:
+        key and output of the stage as an array
+    """
+
+    def run(self, stage, source, params, func):
+        key = self.key(stage, source, params)
+
+        value = self.get(key)
+        if value is None:
+            value = np.asarray(func())
+            self.put(key, value)
+
+        return key, value
+
+    """
+    This function finds the entries of the cache.
+    return:
+        list of (time of modification, size, path) of the entries and their
+        total size
+    """
+
+    def scan(self):
+        entries = []
+        total = 0
+
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith(EXTENSION):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+
+        return entries, total
+
+    """
+    This function removes the least recently used entries of a cache larger
+    than `max_bytes` until it fits in `LOW_WATER` of it. The directory is
+    scanned again, so that the entries written by other processes are
+    counted as well.
+    """
+
+    def evict(self):
+        entries, total = self.scan()
+
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= LOW_WATER * self.max_bytes:
+                    break
+
+        self.size = total
+
+    """
+    return:
+        dictionary with the no. of hits and misses so far
+    """
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
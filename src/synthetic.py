@@ -0,0 +1,155 @@
+"""
+This script is used to generate synthetic multi-lead ECG recordings. They
+are used to benchmark and check the pipeline as the real Database is not
+part of the repository. Each heartbeat is the sum of gaussian P, Q, R, S
+and T waves whose timing follows a RR series with respiratory modulation
+and random heart rate variability. Baseline wander, powerline interference
+and white noise are added on top. The same parameters and seed always give
+the same recording.
+"""
+
+import os
+
+import numpy as np
+import wfdb as wf
+
+
+# offset from the R peak (s), width (s) and amplitude (mV) of each wave
+WAVES = [
+    (-0.20, 0.025, 0.15),   # P
+    (-0.03, 0.010, -0.10),  # Q
+    (0.00, 0.012, 1.00),    # R
+    (0.03, 0.010, -0.25),   # S
+    (0.25, 0.060, 0.30),    # T
+]
+
+# gain of each lead, leads after these reuse them cyclically
+LEAD_GAINS = [1.0, 0.6, -0.4, 0.8]
+
+
+"""
+This function generates the times of the R peaks.
+params:
+    duration -> duration of the recording in seconds
+    heart_rate -> mean heart rate in beats per minute
+    hrv -> relative standard deviation of the RR intervals
+    rng -> random generator
+return:
+    array with the time of each R peak in seconds
+"""
+
+def beat_times(duration, heart_rate, hrv, rng):
+    mean_rr = 60.0 / heart_rate
+    count = int(duration / (mean_rr * (1.0 - 3.0 * hrv))) + 2
+
+    phase = np.arange(count) * mean_rr
+    rr = mean_rr * (1.0 + 0.5 * hrv * np.sin(2 * np.pi * 0.25 * phase)
+                    + hrv * rng.standard_normal(count))
+    rr = np.maximum(rr, 0.3)
+
+    times = 0.5 + np.cumsum(rr)
+    return times[times < duration - 0.5]
+
+
+"""
+This function generates a synthetic recording.
+params:
+    fs -> sampling frequency
+    duration -> duration of the recording in seconds
+    heart_rate -> mean heart rate in beats per minute
+    hrv -> relative standard deviation of the RR intervals
+    noise -> standard deviation of the white noise in mV
+    wander -> amplitude of the baseline wander in mV
+    powerline -> amplitude of the 50 Hz interference in mV
+    leads -> no. of leads
+    seed -> seed of the random generator
+return:
+    array of shape (no. of samples, no. of leads) and the indices of the
+    R peaks
+"""
+
+def generate(fs=360, duration=60.0, heart_rate=70.0, hrv=0.05, noise=0.02,
+             wander=0.1, powerline=0.01, leads=2, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(duration * fs)
+    t = np.arange(n) / fs
+
+    times = beat_times(duration, heart_rate, hrv, rng)
+    rr = np.diff(times, prepend=times[0] - 60.0 / heart_rate) if len(times) else times
+
+    signal = np.zeros((n, leads))
+
+    for lead in range(leads):
+        gain = LEAD_GAINS[lead % len(LEAD_GAINS)]
+        # small differences in the shape of the beats of each lead
+        scale = 1.0 + 0.1 * rng.standard_normal(len(WAVES))
+
+        for wave, (offset, width, amplitude) in enumerate(WAVES):
+            if wave == len(WAVES) - 1:
+                # QT interval gets shorter as the heart rate increases
+                centres = times + offset * np.sqrt(rr / (60.0 / heart_rate))
+            else:
+                centres = times + offset
+
+            half = int(np.ceil(4 * width * fs))
+            window = np.arange(-half, half + 1)
+
+            # sample indices around every centre, added at once
+            start = np.round(centres * fs).astype(np.int64)
+            idx = start[:, np.newaxis] + window
+            values = np.exp(-0.5 * ((idx / fs - centres[:, np.newaxis]) / width) ** 2)
+
+            valid = (idx >= 0) & (idx < n)
+            np.add.at(signal[:, lead], idx[valid],
+                      gain * scale[wave] * amplitude * values[valid])
+
+    phase = rng.uniform(0, 2 * np.pi, 2)
+    signal += (wander * np.sin(2 * np.pi * 0.2 * t + phase[0])
+               + 0.5 * wander * np.sin(2 * np.pi * 0.05 * t + phase[1]))[:, np.newaxis]
+    signal += powerline * np.sin(2 * np.pi * 50.0 * t)[:, np.newaxis]
+    signal += noise * rng.standard_normal(signal.shape)
+
+    return signal, np.round(times * fs).astype(np.int64)
+
+
+"""
+This function writes a synthetic recording as a wfdb record.
+params:
+    folder -> folder in which the record is written
+    name -> name of the record
+    signal -> array of shape (no. of samples, no. of leads)
+    fs -> sampling frequency
+return: None
+"""
+
+def write_wfdb(folder, name, signal, fs):
+    leads = signal.shape[1]
+    wf.wrsamp(name, fs=fs, units=["mV"] * leads,
+              sig_name=["lead%d" % (lead + 1) for lead in range(leads)],
+              p_signal=signal, fmt=["16"] * leads, write_dir=str(folder))
+
+
+"""
+This function creates a Database of synthetic recordings with the `raw_data`
+and `csv_data` folders expected by `paths.find_paths`.
+params:
+    folder -> folder in which the Database is created
+    records -> no. of records
+    fs -> sampling frequency
+    duration -> duration of each recording in seconds
+    **kwargs -> other parameters of `generate`
+return:
+    path of the Database
+"""
+
+def make_database(folder, records=1, fs=360, duration=60.0, **kwargs):
+    database = os.path.join(str(folder), "Database")
+    raw_path = os.path.join(database, "raw_data")
+    os.makedirs(raw_path, exist_ok=True)
+    os.makedirs(os.path.join(database, "csv_data"), exist_ok=True)
+
+    for record in range(records):
+        signal, _ = generate(fs, duration, seed=record, **kwargs)
+        write_wfdb(raw_path, str(100 + record), signal, fs)
+
+    return database
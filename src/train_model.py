@@ -4,15 +4,17 @@ is verbose and tells everything about the model like its architecture, live
 accuracy and other parameters of each epoch and so on.
 """
 
-import tensorflow as tf
+import json
+
 import keras 
 from keras.layers import Dense, Convolution1D, MaxPooling1D, GlobalAveragePooling1D
 from keras.models import Sequential
 from sklearn.model_selection import train_test_split
-import pandas as pd
 import numpy as np
 from livelossplot import PlotLossesKeras
 
+import dataset
+
 
 """
 This function creates the architecture of the CNN model.
@@ -21,7 +23,7 @@ params:
 	depth -> hwow deep the network is
 	out -> no. of neurons in output layer
 return:
-	the compiled model
+	the compiled model, which takes integer encoded labels
 """
 
 def make_model(feature, depth, out):
@@ -32,48 +34,57 @@ def make_model(feature, depth, out):
     model.add(GlobalAveragePooling1D())
     model.add(Dense(32, activation = 'relu'))
     model.add(Dense(out, activation = 'softmax'))
-    model.compile(optimizer = 'adam', loss = 'categorical_crossentropy', metrics = ['accuracy', tf.keras.metrics.AUC(name = 'auc')])
+    model.compile(optimizer = 'adam', loss = 'sparse_categorical_crossentropy', metrics = ['accuracy'])
     return model
 
 
 """
 This function is used to train our CNN model on the input data and
-then save the model for further use.
+then save the model for further use. The dataset is memory mapped and fed
+to the model in shuffled batches read by a background thread, so that it
+never has to be loaded in memory as a whole. Labels are integer encoded,
+the patient ids of the classes being saved along with the model.
+params:
+	batch_size -> no. of segments in each batch
+	num_epochs -> no. of epochs to train for
+	prefetch -> no. of batches read ahead of the model
 """
 
-def train_cnn():
-	df = pd.read_csv('../normalised_data.csv')
-	N = len(df.columns) - 1
-	N = str(N)
-
-	df[N]=df[N].apply(str)
+def train_cnn(batch_size = 32, num_epochs = 10, prefetch = 4):
+	X, y = dataset.load_dataset('../normalised_data')
+	classes, y = dataset.encode_labels(y)
 
-	print("============================= DataFrame Loaded ============================")
+	print("============================== Dataset Loaded =============================")
 
-	X = df.iloc[:, :-1]
-	y = df.iloc[:, -1:]
+	rows = np.arange(len(X))
+	train_rows, test_rows = train_test_split(rows, test_size = 0.2)
+	train_rows, val_rows = train_test_split(train_rows, test_size = 0.25)
 
-	X_train, X_test, y_train, y_test = train_test_split(X, y, test_size = 0.2)
+	train_batches = dataset.BatchLoader(X, y, train_rows, batch_size, prefetch = prefetch)
+	val_batches = dataset.BatchLoader(X, y, val_rows, batch_size, shuffle = False, prefetch = prefetch)
+	test_batches = dataset.BatchLoader(X, y, test_rows, batch_size, shuffle = False,
+	                                   prefetch = prefetch, repeat = False)
 
-	X_train = np.expand_dims(X_train, 2)
-	X_test = np.expand_dims(X_test, 2)
-
-	y_train = pd.get_dummies(y_train)
-	y_test = pd.get_dummies(y_test)
-
-	_, feature, depth = X_train.shape
-	number_of_patients = y_train.shape[1]
+	feature = X.shape[1]
+	# segments of several leads have one channel per lead
+	depth = X.shape[2] if X.ndim == 3 else 1
+	number_of_patients = len(classes)
 	model = make_model(feature, depth, number_of_patients)
 
 	print("\n======================== Model Architecture Defined =======================\n")
 
 	model.summary()
-	num_epochs=10
 
-	history = model.fit(X_train, y_train, epochs = num_epochs, callbacks = [PlotLossesKeras()], validation_split = 0.25)
-	score = model.evaluate(X_test, y_test, verbose = 1)
+	history = model.fit(iter(train_batches), steps_per_epoch = len(train_batches), epochs = num_epochs,
+	                    callbacks = [PlotLossesKeras()],
+	                    validation_data = iter(val_batches), validation_steps = len(val_batches))
+	score = model.evaluate(iter(test_batches), steps = len(test_batches), verbose = 1)
+
+	# the classes are written first, so that a saved model always has them
+	with open('../trained_model_classes.json', 'w') as file:
+		json.dump(classes.tolist(), file)
 
-	model.save('../trained_model') 
+	model.save('../trained_model.keras')
 
 	print("\n============================ Training Completed ===========================\n")
 
@@ -0,0 +1,549 @@
+"""
+This script is used to preprocess the Database with several workers, on
+one or more machines, which share a directory. No broker is needed, the
+directory holds:
+    queue.json -> ids of the records and settings of the preprocessing
+    leases/ -> one file per record being processed, holding its worker
+    shards/ -> segments of every record which is done, one file per record
+    errors/ -> traceback of every record which failed
+A worker claims a record by creating its lease file, which only succeeds
+for one of them. The lease is renewed while the record is processed, and a
+lease which has not been renewed for `timeout` seconds (e.g. its worker
+died) can be taken over by another worker. Shards are written to a
+temporary file and renamed, so a shard is either complete or missing and
+records which have a shard are skipped. If everything is stopped, running
+the workers again only processes the records which are not done yet.
+Once every record is done, `merge` builds the dataset from the shards in
+the same way as `normalise.get_normalised_data`.
+Example, with 4 worker processes on this machine:
+    python work_queue.py init /shared/queue --format store --width 256
+    python work_queue.py work /shared/queue --processes 4
+    python work_queue.py merge /shared/queue ../normalised_data
+"""
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import dataset
+import fileutil
+import load_data
+import metrics
+import normalise
+import paths as const
+import pipeline
+import preprocess
+
+
+QUEUE_FILE = "queue.json"
+LEASES = "leases"
+SHARDS = "shards"
+ERRORS = "errors"
+
+# seconds after which a lease which is not renewed can be taken over
+LEASE_TIMEOUT = 600
+
+
+"""
+This function creates a queue, or checks that an existing queue has the
+same settings so that workers started later join it.
+params:
+    folder -> shared directory of the queue
+    ids -> ids of the records to process, all of them if None
+    fmt -> format of the data to load (`csv`, `store` or `raw`)
+    width -> if given, segments of this many samples are cut directly
+    leads -> no. of leads processed
+    config -> pipeline configuration, the default one if None
+return:
+    settings of the queue
+"""
+
+def init_queue(folder, ids=None, fmt="csv", width=None, leads=1, config=None):
+    if ids is None:
+        const.find_paths(fmt=fmt)
+        ids = load_data.record_ids(fmt)
+    if config is None:
+        config = pipeline.PipelineConfig()
+
+    settings = json.loads(json.dumps({
+        "ids": list(ids),
+        "format": fmt,
+        "width": width,
+        "leads": leads,
+        "config": vars(config),
+    }))
+
+    for name in (LEASES, SHARDS, ERRORS):
+        os.makedirs(os.path.join(folder, name), exist_ok=True)
+
+    existing = read_queue(folder)
+    if existing is not None:
+        if existing != settings:
+            raise ValueError("A queue with other settings already exists in %s." % folder)
+        return existing
+
+    fileutil.write_atomic(os.path.join(folder, QUEUE_FILE),
+                          lambda file: json.dump(settings, file, indent=1), "w")
+    return settings
+
+
+"""
+This function reads the settings of a queue.
+params:
+    folder -> shared directory of the queue
+return:
+    settings of the queue, None if there is no queue
+"""
+
+def read_queue(folder):
+    try:
+        with open(os.path.join(folder, QUEUE_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+"""
+This function gives the file of a record in a folder of the queue.
+params:
+    folder -> shared directory of the queue
+    kind -> `LEASES`, `SHARDS` or `ERRORS`
+    record_id -> id of the record
+return:
+    path of the file
+"""
+
+def record_path(folder, kind, record_id):
+    extension = {LEASES: ".lease", SHARDS: ".npz", ERRORS: ".txt"}[kind]
+    return os.path.join(folder, kind, record_id + extension)
+
+
+"""
+This class is the lease of a worker on a record. The lease file holds the
+name of the worker and its modification time is the last time it was
+renewed. While the lease is held a background thread renews it.
+params:
+    path -> lease file
+    owner -> name of the worker
+    timeout -> seconds after which a lease which is not renewed is stale
+"""
+
+class Lease:
+    def __init__(self, path, owner, timeout=LEASE_TIMEOUT):
+        self.path = path
+        self.owner = owner
+        self.timeout = timeout
+        self.stop = threading.Event()
+        self.thread = None
+
+    """
+    return:
+        True if the lease file exists and has not been renewed in time
+    """
+
+    def is_stale(self):
+        try:
+            return time.time() - os.path.getmtime(self.path) > self.timeout
+        except FileNotFoundError:
+            return False
+
+    """
+    This function creates the lease file, which only succeeds if it does
+    not exist yet.
+    return:
+        True if the lease was created
+    """
+
+    def create(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, "w") as file:
+            file.write(self.owner)
+        return True
+
+    """
+    This function takes a stale lease over. The stale file is first moved
+    away, which only succeeds for one worker. If it turns out to have been
+    renewed in the meantime it is put back.
+    return:
+        True if the stale lease was removed
+    """
+
+    def break_stale(self):
+        moved = "%s.%s.%d.stale" % (self.path, self.owner, threading.get_ident())
+        try:
+            os.rename(self.path, moved)
+        except FileNotFoundError:
+            return False
+
+        if time.time() - os.path.getmtime(moved) <= self.timeout:
+            # another worker renewed or replaced it, give it back
+            try:
+                os.link(moved, self.path)
+            except FileExistsError:
+                pass
+            os.remove(moved)
+            return False
+
+        os.remove(moved)
+        return True
+
+    """
+    This function tries to take the lease.
+    return:
+        True if the lease is held by this worker
+    """
+
+    def acquire(self):
+        if not self.create():
+            if not self.is_stale() or not self.break_stale() or not self.create():
+                return False
+
+        self.stop.clear()
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+        self.thread.start()
+        return True
+
+    """
+    This function renews the lease until it is released. It is run by the
+    background thread.
+    """
+
+    def renew(self):
+        while not self.stop.wait(self.timeout / 4):
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    """
+    This function releases the lease, unless it has been taken over.
+    return: None
+    """
+
+    def release(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        try:
+            with open(self.path) as file:
+                owner = file.read()
+            if owner == self.owner:
+                os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+"""
+This function writes the shard of a record. The segments are kept as the
+concatenation of their samples along with their lengths, so that segments
+of different lengths can be stored.
+params:
+    path -> shard file
+    segments -> segmented data of the record
+return: None
+"""
+
+def write_shard(path, segments):
+    lengths = np.array([len(segment) for segment in segments], dtype=np.int64)
+    if len(segments) > 0:
+        samples = np.concatenate(list(segments)).astype(np.float32)
+    else:
+        samples = np.zeros(0, dtype=np.float32)
+
+    fileutil.write_atomic(path, lambda file: np.savez(file, samples=samples, lengths=lengths))
+
+
+"""
+This function reads the shard of a record.
+params:
+    path -> shard file
+return:
+    list of segments
+"""
+
+def read_shard(path):
+    with np.load(path) as shard:
+        lengths = shard["lengths"]
+        samples = shard["samples"]
+
+    return np.split(samples, np.cumsum(lengths)[:-1]) if len(lengths) else []
+
+
+"""
+This function runs a worker, which processes the records of the queue
+until none is left to claim. Records leased by other workers are left to
+them.
+params:
+    folder -> shared directory of the queue
+    name -> name of the worker, defaults to the host name and process id
+    cache_dir -> directory of the stage cache, no cache is used if None
+    cache_size -> max size of the stage cache in bytes
+    timeout -> seconds after which a lease which is not renewed is stale
+    retry -> if True records which failed before are tried again
+return:
+    no. of records processed by this worker
+"""
+
+def run_worker(folder, name=None, cache_dir=None, cache_size=2 * 1024**3,
+               timeout=LEASE_TIMEOUT, retry=False):
+    settings = read_queue(folder)
+    if settings is None:
+        raise FileNotFoundError("No queue in %s." % folder)
+
+    if name is None:
+        name = "%s-%d" % (socket.gethostname(), os.getpid())
+    config = pipeline.PipelineConfig(**settings["config"])
+
+    const.find_paths(fmt=settings["format"])
+    # loaded once per worker instead of once per record
+    index = load_data.csv_index(settings["format"])
+
+    ids = settings["ids"]
+    # workers start at different records so that they rarely compete
+    start = sum(name.encode("utf-8")) % max(len(ids), 1)
+    ids = ids[start:] + ids[:start]
+
+    processed = 0
+    for record_id in ids:
+        shard_path = record_path(folder, SHARDS, record_id)
+        error_path = record_path(folder, ERRORS, record_id)
+        if os.path.exists(shard_path) or (os.path.exists(error_path) and not retry):
+            continue
+
+        lease = Lease(record_path(folder, LEASES, record_id), name, timeout)
+        if not lease.acquire():
+            continue
+
+        try:
+            # another worker may have finished it before the lease was taken
+            if os.path.exists(shard_path):
+                continue
+
+            metrics.progress("Worker", name, "preprocessing patient", record_id)
+            try:
+                _, segments, stats = preprocess.preprocess_record(
+                    record_id, settings["format"], cache_dir, cache_size,
+                    settings["width"], settings["leads"], config, None, index)
+            except Exception:
+                error = traceback.format_exc().encode("utf-8")
+                fileutil.write_atomic(error_path, lambda file: file.write(error))
+                continue
+
+            metrics.merge(stats["metrics"])
+            write_shard(shard_path, segments)
+            if os.path.exists(error_path):
+                os.remove(error_path)
+            processed += 1
+        finally:
+            lease.release()
+
+    return processed
+
+
+"""
+This function gives the progress of a queue.
+params:
+    folder -> shared directory of the queue
+return:
+    dictionary with the no. of records `done`, `leased`, `failed` and
+    `pending` and the ids of the records which are not done
+"""
+
+def queue_status(folder):
+    settings = read_queue(folder)
+    if settings is None:
+        raise FileNotFoundError("No queue in %s." % folder)
+
+    status = {"done": 0, "leased": 0, "failed": 0, "pending": 0, "missing": []}
+    for record_id in settings["ids"]:
+        if os.path.exists(record_path(folder, SHARDS, record_id)):
+            status["done"] += 1
+            continue
+
+        status["missing"].append(record_id)
+        if os.path.exists(record_path(folder, LEASES, record_id)):
+            status["leased"] += 1
+        elif os.path.exists(record_path(folder, ERRORS, record_id)):
+            status["failed"] += 1
+        else:
+            status["pending"] += 1
+
+    return status
+
+
+"""
+This function builds the dataset from the shards. Segments are trimmed to
+the smallest segment of all the records, as done by
+`normalise.get_normalised_data`, or fitted to a target length.
+params:
+    folder -> shared directory of the queue
+    path -> folder in which the binary dataset is written
+    length -> if given, every segment is fitted to this many samples
+    fit -> `crop` or `resample`, see `normalise.fit_length`
+    append -> if True only the records missing from the dataset in `path`
+              are added to it
+    partial -> if True the records which are not done are left out,
+               otherwise the merge fails if any record is not done
+return:
+    no. of records whose segments were written
+"""
+
+def merge(folder, path, length=None, fit="crop", append=False, partial=False):
+    settings = read_queue(folder)
+    status = queue_status(folder)
+    if status["missing"] and not partial:
+        raise RuntimeError("%d records are not done yet: %s"
+                           % (len(status["missing"]), ", ".join(status["missing"][:10])))
+
+    ids = [record_id for record_id in settings["ids"]
+           if os.path.exists(record_path(folder, SHARDS, record_id))]
+
+    size = length
+    if size is None:
+        # only the lengths are read to find the smallest segment
+        size = np.iinfo(np.int64).max
+        for record_id in ids:
+            with np.load(record_path(folder, SHARDS, record_id)) as shard:
+                if len(shard["lengths"]):
+                    size = min(size, int(shard["lengths"].min()))
+        if size == np.iinfo(np.int64).max:
+            raise ValueError("The shards do not hold any segment.")
+
+    leads = settings["leads"] if settings["leads"] > 1 else None
+    written = 0
+
+    with dataset.DatasetWriter(path, size, leads, append) as writer:
+        for idx, record_id in enumerate(ids):
+            if record_id in writer.patients:
+                continue
+
+            metrics.progress("Merging patient", idx + 1, "of", len(ids))
+            segments = read_shard(record_path(folder, SHARDS, record_id))
+            fitted = np.empty((len(segments),) + writer.shape, dtype=np.float32)
+            for ind, segment in enumerate(segments):
+                if length is None:
+                    fitted[ind] = normalise.normalise(segment, size)
+                else:
+                    fitted[ind] = normalise.fit_length(segment, size, fit)
+
+            writer.write(fitted, record_id)
+            written += len(fitted) > 0
+
+    return written
+
+
+"""
+This function runs several workers as processes of this machine.
+params:
+    folder -> shared directory of the queue
+    processes -> no. of worker processes
+    **kwargs -> other parameters of `run_worker`
+return:
+    no. of records processed by all the workers
+"""
+
+def run_workers(folder, processes, **kwargs):
+    if processes == 1:
+        return run_worker(folder, **kwargs)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(run_worker, folder, **kwargs) for _ in range(processes)]
+        return sum(future.result() for future in futures)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess the Database with "
+                                                 "workers sharing a directory.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    init = commands.add_parser("init", help="create the queue")
+    init.add_argument("queue", help="shared directory of the queue")
+    init.add_argument("--format", choices=["csv", "store", "raw"], default="csv")
+    init.add_argument("--width", type=int, default=None,
+                      help="no. of samples in each segment")
+    init.add_argument("--leads", type=int, default=1,
+                      help="no. of leads used as channels of the segments")
+    init.add_argument("--config", default=None,
+                      help="json file with the parameters of the preprocessing stages")
+    init.add_argument("--window", type=pipeline.parse_window, action="append",
+                      default=None, help="time window start:end in seconds of "
+                                         "each record to process, may be repeated. "
+                                         "It is relative to the converted part for "
+                                         "the csv and store formats")
+
+    work = commands.add_parser("work", help="run workers until no record is left")
+    work.add_argument("queue", help="shared directory of the queue")
+    work.add_argument("--processes", type=int, default=1,
+                      help="no. of worker processes on this machine")
+    work.add_argument("--cache-dir", default=None,
+                      help="directory of the stage cache")
+    work.add_argument("--cache-size", type=float, default=2.0,
+                      help="max size of the cache in GB")
+    work.add_argument("--timeout", type=float, default=LEASE_TIMEOUT,
+                      help="seconds after which the lease of a dead worker "
+                           "is taken over")
+    work.add_argument("--retry", action="store_true",
+                      help="try the records which failed again")
+    work.add_argument("--quiet", action="store_true",
+                      help="do not print the progress of every patient")
+
+    status = commands.add_parser("status", help="print the progress of the queue")
+    status.add_argument("queue", help="shared directory of the queue")
+
+    merge_cmd = commands.add_parser("merge", help="build the dataset from the shards")
+    merge_cmd.add_argument("queue", help="shared directory of the queue")
+    merge_cmd.add_argument("output", nargs="?", default="../normalised_data",
+                           help="folder of the binary dataset")
+    merge_cmd.add_argument("--length", type=int, default=None,
+                           help="fit every segment to this many samples (default: "
+                                "size of the smallest segment)")
+    merge_cmd.add_argument("--fit", choices=["crop", "resample"], default="crop")
+    merge_cmd.add_argument("--append", action="store_true",
+                           help="append the records missing from the dataset")
+    merge_cmd.add_argument("--partial", action="store_true",
+                           help="leave out the records which are not done")
+
+    args = parser.parse_args()
+
+    if args.command == "init":
+        config = None
+        if args.config is not None:
+            config = pipeline.PipelineConfig.load(args.config)
+        if args.window:
+            config = config or pipeline.PipelineConfig()
+            config.windows = tuple(args.window)
+        settings = init_queue(args.queue, None, args.format, args.width, args.leads, config)
+        print("Queue of", len(settings["ids"]), "records in", args.queue)
+
+    elif args.command == "work":
+        metrics.set_quiet(args.quiet)
+        processed = run_workers(args.queue, args.processes, cache_dir=args.cache_dir,
+                                cache_size=int(args.cache_size * 1024**3),
+                                timeout=args.timeout, retry=args.retry)
+        print("")
+        print("Records processed:", processed)
+
+    elif args.command == "status":
+        status = queue_status(args.queue)
+        print("done: %(done)d, leased: %(leased)d, failed: %(failed)d, "
+              "pending: %(pending)d" % status)
+
+    else:
+        written = merge(args.queue, args.output, args.length, args.fit,
+                        args.append, args.partial)
+        print("")
+        print("========================= Merge Completed =========================")
+        print("Records written:", written)